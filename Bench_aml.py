@@ -0,0 +1,387 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# AML benchmark
+#
+# usage:
+#   python Bench_aml.py                  run all case, compare with baseline
+#   python Bench_aml.py --save-baseline  run all case, save as baseline
+#   python Bench_aml.py --case for_list_10k --engine codegen
+#
+# every case run in a child process, report throughput, latency
+# percentile of one record and peak memory, a regression over
+# --threshold of baseline exit 1
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import types
+sys.path.insert(0, '../')
+
+import aml as aml_module
+from aml import AML, AMLMap as AMap, AMLAction as Action
+
+
+BASELINE_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+
+ENGINES = ('sm', 'plan', 'codegen')
+
+
+### cases
+
+def make_template():
+    return {
+        "represent_type": "list",
+        "represent_data": [
+        AMap(action=Action('location', ['level'])),
+        {
+        "title"               : AMap(location='level2', key='policyName', type=str),
+        "ticket_description"  : AMap(key='remark', type=str),
+        "price"               : AMap(key='tcPrice', type=int),
+        "sell_status"         : 2,
+        "card": AMap(action=Action('if_key', 'tcPrice', '>', 10,
+                                   block_template={"type": "fill"},
+                                   else_template={"type": "empty"})),
+        "items": [AMap(location=['items'], action=Action('for_list', template={
+        "name": AMap(key='name', type=str),
+        "price": AMap(key='price', type=int),
+        "info": {"tag": "item", "id": AMap(key='id')}}))]
+        },
+        ]
+        }
+
+def make_data(items=20):
+    return {
+        'level': {
+        'level2': {'policyName': 'policy'},
+        'remark': 'remark',
+        'tcPrice': 15,
+        'items': [{'name': 'n%s' % i, 'price': str(i), 'id': i}
+                  for i in range(items)]
+        }
+        }
+
+def case_flat_wide(width=200):
+    template = dict(('field%s' % i, AMap(key='f%s' % i, type=int))
+                    for i in range(width))
+    data = dict(('f%s' % i, str(i)) for i in range(width))
+    return template, data
+
+def case_deep_nesting(depth=50):
+    template = {'value': AMap(key='v')}
+    for i in range(depth):
+        template = {'next': template, 'level': i, 'value': AMap(key='v')}
+    return template, {'v': 1}
+
+def case_for_list(items):
+    template = {
+        'count': AMap(key='count'),
+        'items': [AMap(location=['items'], action=Action('for_list', template={
+        'id': AMap(key='id'),
+        'name': AMap(key='name', type=str),
+        'price': AMap(key='price', type=float),
+        'tag': 'item',
+        'flag': True}))]
+        }
+    data = {'count': items,
+            'items': [{'id': i, 'name': 'n%s' % i, 'price': '%s.5' % i}
+                      for i in xrange(items)]}
+    return template, data
+
+def case_if_key(branches=50):
+    template = [AMap(action=Action('if_key', 'k%s' % i, '>=', 1,
+                                   block_template={'branch': 'block',
+                                                   'value': AMap(key='k%s' % i)},
+                                   else_template={'branch': 'else'}))
+                for i in range(branches)]
+    data = dict(('k%s' % i, i % 2) for i in range(branches))
+    return template, data
+
+def case_location_chains(fields=50, depth=8):
+    path = ['l%s' % i for i in range(depth)]
+    leaf = dict(('f%s' % i, i) for i in range(fields))
+    data = leaf
+    for key in reversed(path):
+        data = {key: data}
+    data = {'root': data, 'local': data}
+    template = {'local': {
+        'amap': AMap(action=Action('location', ['local'])),
+        }}
+    for i in range(fields):
+        template['local']['f%s' % i] = AMap(location=path, key='f%s' % i)
+        template['r%s' % i] = AMap(root_location=['root'] + path,
+                                   key='f%s' % i)
+    return template, data
+
+# name: (builder, records)
+CASES = [
+    ('sample', lambda: (make_template(), make_data()), 2000),
+    ('flat_wide', case_flat_wide, 1000),
+    ('deep_nesting', case_deep_nesting, 1000),
+    ('for_list_10k', lambda: case_for_list(10000), 5),
+    ('for_list_100k', lambda: case_for_list(100000), 1),
+    ('if_key', case_if_key, 1000),
+    ('location_chains', case_location_chains, 1000),
+    ]
+
+LARGE_cases = [
+    ('for_list_1m', lambda: case_for_list(1000000), 1),
+    ]
+
+
+### memory
+
+SHARED_types = (type, types.FunctionType, types.BuiltinFunctionType,
+                types.ModuleType, types.MethodType)
+
+def deep_sizeof(obj, seen=None):
+    """
+    bytes of obj and the objects it reference, class and function
+    are shared by all templates and not count
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, SHARED_types):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+def bench_template_memory(count=1000):
+    templates = [make_template() for i in range(count)]
+    return deep_sizeof(templates) / float(count)
+
+def peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+### allocation
+
+def count_allocations(func):
+    """
+    call func, return {class name: instance number} of aml classes
+    """
+    counter = {}
+    patched = []
+
+    def counting_init(cls, init):
+        def __init__(self, *args, **kwargs):
+            if type(self) is cls:
+                counter[cls.__name__] = counter.get(cls.__name__, 0) + 1
+            init(self, *args, **kwargs)
+        return __init__
+
+    for name in dir(aml_module):
+        cls = getattr(aml_module, name)
+        if isinstance(cls, type) and cls.__module__ == aml_module.__name__:
+            patched.append((cls, cls.__dict__.get('__init__')))
+            cls.__init__ = counting_init(cls, cls.__init__)
+    try:
+        func()
+    finally:
+        for cls, init in patched:
+            if init is None:
+                del cls.__init__
+            else:
+                cls.__init__ = init
+    return counter
+
+def bench_run_allocations(runs=100):
+    template = make_template()
+    data = make_data()
+    aml = AML()
+    aml.run(template, data)
+    counter = count_allocations(lambda: [aml.run(template, data)
+                                         for i in range(runs)])
+    return dict((name, count / float(runs))
+                for name, count in counter.items())
+
+
+### run
+
+def engine_run(engine, template):
+    aml = AML()
+    if engine == 'sm':
+        return lambda data: aml.run(template, data)
+    return aml.compile(template, backend=engine).run
+
+def percentile(sorted_values, percent):
+    idx = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+def bench_case(builder, records, engine, repeat=3):
+    """
+    run in child process, return metric dict, throughput of the
+    fastest repeat
+    """
+    template, data = builder()
+    run = engine_run(engine, template)
+    memory_start = peak_memory_kb()
+    run(data)
+    latencies = []
+    timer = time.time
+    best = None
+    for i in xrange(repeat):
+        start = timer()
+        for j in xrange(records):
+            record_start = timer()
+            run(data)
+            latencies.append(timer() - record_start)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    latencies.sort()
+    return {
+        'throughput': records / best,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p90_us': percentile(latencies, 90) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'peak_kb': max(0, peak_memory_kb() - memory_start),
+        }
+
+def _child(queue, func, args):
+    try:
+        queue.put(('ok', func(*args)))
+    except Exception as e:
+        queue.put(('error', '%s: %s' % (e.__class__.__name__, e)))
+
+def run_in_child(func, *args):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child, args=(queue, func, args))
+    process.start()
+    state, result = queue.get()
+    process.join()
+    if state != 'ok':
+        raise RuntimeError(result)
+    return result
+
+
+### baseline
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        f.write('\n')
+
+def compare(results, baseline, threshold):
+    """
+    return regression message list
+    """
+    regressions = []
+    for name, metric in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if 'throughput' in metric and \
+           metric['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append('%s throughput %.1f/s < baseline %.1f/s' % (
+                name, metric['throughput'], base['throughput']))
+        # 1MB for rss noise
+        if 'peak_kb' in metric and \
+           metric['peak_kb'] > base['peak_kb'] * (1 + threshold) + 1024:
+            regressions.append('%s peak memory %dKB > baseline %dKB' % (
+                name, metric['peak_kb'], base['peak_kb']))
+        for field in ('bytes_per_template', 'objects_per_run'):
+            if field in metric and \
+               metric[field] > base[field] * (1 + threshold):
+                regressions.append('%s %s %.1f > baseline %.1f' % (
+                    name, field, metric[field], base[field]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='AML benchmark')
+    parser.add_argument('--case', action='append',
+                        help='case name, default all')
+    parser.add_argument('--engine', action='append', choices=ENGINES,
+                        help='engine, default all')
+    parser.add_argument('--large', action='store_true',
+                        help='also run large case (for_list 1M)')
+    parser.add_argument('--baseline', default=BASELINE_file)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repeat of case, best throughput, default 3')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='regression threshold, default 0.2 (20%%)')
+    args = parser.parse_args(argv)
+
+    cases = CASES + (LARGE_cases if args.large else [])
+    if args.case:
+        cases = [case for case in cases if case[0] in args.case]
+    engines = args.engine or ENGINES
+
+    out = sys.stdout
+    results = {}
+    out.write('%-28s %12s %10s %10s %10s %10s\n' % (
+        'case:engine', 'records/s', 'p50 us', 'p90 us', 'p99 us', 'peak KB'))
+    for name, builder, records in cases:
+        for engine in engines:
+            key = '%s:%s' % (name, engine)
+            metric = run_in_child(bench_case, builder, records, engine,
+                                  args.repeat)
+            results[key] = metric
+            out.write('%-28s %12.1f %10.1f %10.1f %10.1f %10d\n' % (
+                key, metric['throughput'], metric['p50_us'],
+                metric['p90_us'], metric['p99_us'], metric['peak_kb']))
+
+    if not args.case:
+        results['template_memory'] = {
+            'bytes_per_template': bench_template_memory()}
+        allocations = bench_run_allocations()
+        results['run_allocations'] = {
+            'objects_per_run': sum(allocations.values())}
+        out.write('template memory: %.0f bytes/template\n' %
+                  results['template_memory']['bytes_per_template'])
+        out.write('run allocations: %.1f objects/run %s\n' % (
+            results['run_allocations']['objects_per_run'], ', '.join(
+                '%s:%.1f' % item for item in sorted(allocations.items()))))
+
+    if args.save_baseline:
+        baseline = load_baseline(args.baseline) or {}
+        baseline.update(results)
+        save_baseline(args.baseline, baseline)
+        out.write('baseline saved: %s\n' % args.baseline)
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        out.write('no baseline: %s, run with --save-baseline\n' %
+                  args.baseline)
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        out.write('\n!!! PERFORMANCE REGRESSION over %.0f%% of baseline !!!\n'
+                  % (args.threshold * 100))
+        for message in regressions:
+            out.write('  %s\n' % message)
+        return 1
+    out.write('no regression over %.0f%% of baseline\n' %
+              (args.threshold * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
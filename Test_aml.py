@@ -12,7 +12,7 @@ sys.path.insert(0, '../')
 
 logging.getLogger().setLevel(logging.DEBUG)
 
-from aml import AML, AMLMap as AMap, AMLAction as Action
+from aml import AML, AMLMap as AMap, AMLAction as Action, AMLRecordError
 
 
 def setUp():
@@ -337,3 +337,980 @@ def Test_for():
 
     assert r == check_result, 'if faield' \
            ' check_result: %s result: %s' % (check_result, r)
+
+def Test_compile():
+    template = {
+        "represent_type": "list",
+        "represent_data": [
+        AMap(action=Action('location', ['level'])),
+        {
+        "title"               : AMap(location='level2', key='policyName', type=str),
+        'root_data'           : AMap(root_location=['ROOT_path', 't', 1, 'r2', 2],
+                                     index=1, type=str),
+        "price"               : AMap(key='tcPrice', type=int),
+        "miss"                : AMap(key='noKey'),
+        "sell_status"         : 2,
+        "if_else": AMap(action=Action('if_key', 'tcPrice', '>=', 1,
+                                      block_template={"block": AMap(key='remark')},
+                                      else_template={"else": "else"})),
+        "items": [AMap(location=['items'], action=Action('for_list', template={
+        "name": AMap(key='name', type=str),
+        "tag": 'item'}))]
+        },
+        ]
+        }
+
+    data = {
+        'ROOT_path': {
+        't': [{},
+              {'r2': [0, 2302, [1, 'rrrrooootttt']]}
+              ],
+        },
+        'level': {
+        'level2': {
+        'policyName': 'aaaaaaaaaaaaaaaasssss',
+        },
+        'remark': 'bbbbbasdf',
+        'tcPrice': 15,
+        'items': [{'name': 'n1'}, {'name': 'n2'}]
+        }
+        }
+
+    aml = AML()
+    check_result = aml.run(template, data)
+    compiled = aml.compile(template)
+    for i in range(3):
+        r = compiled.run(data)
+        assert r == check_result, 'compile failed' \
+               ' check_result: %s result: %s' % (check_result, r)
+    assert r['represent_data'][0]['items'] == [{'name': 'n1', 'tag': 'item'},
+                                               {'name': 'n2', 'tag': 'item'}]
+
+    from aml import AMLTemplateError
+    for backend in ('plan', 'codegen'):
+        try:
+            aml.compile({'a': {'b': None}}, backend)
+            assert 0, '%s compile unknow node' % backend
+        except AMLTemplateError as e:
+            assert "Unknow node: None, template path 'a.b'" in str(e), e
+
+def Test_compile_codegen():
+    template = {
+        "represent_type": "list",
+        "static": {'a': ['1', 2, {'b': True}]},
+        "represent_data": [
+        AMap(action=Action('location', ['level'])),
+        {
+        "title"               : AMap(location='level2', key='policyName', type=str),
+        "price"               : AMap(key='tcPrice', type=int),
+        "first"               : AMap(location='items', index=1),
+        "miss"                : AMap(key='noKey'),
+        "if_else": AMap(action=Action('if_key', 'tcPrice', '<', 1,
+                                      block_template={"block": AMap(key='remark')},
+                                      else_template={"else": AMap(key='remark')})),
+        "last_item": AMap(location=['items'], action=Action('for_list', template={
+        "name": AMap(key='name', type=str)}))
+        },
+        AMap(location=['items'], action=Action('for_list', template=[
+        AMap(key='name')]))
+        ]
+        }
+
+    data = {
+        'level': {
+        'level2': {
+        'policyName': 'aaaaaaaaaaaaaaaasssss',
+        },
+        'remark': 'bbbbbasdf',
+        'tcPrice': '15',
+        'items': [{'name': 'n1'}, {'name': 'n2'}]
+        }
+        }
+
+    aml = AML()
+    check_result = aml.run(template, data)
+    compiled = aml.compile(template, backend='codegen')
+    assert compiled.source, 'codegen no source'
+    r = compiled.run(data)
+    assert r == check_result, 'compile codegen failed' \
+           ' check_result: %s result: %s' % (check_result, r)
+    assert r['represent_data'][1:] == [['n1'], ['n2']]
+    assert r['represent_data'][0]['last_item'] == {'name': 'n2'}
+
+def Test_run_many():
+    template = {
+        "amap": AMap(action=Action('location', ['level'])),
+        "price": AMap(key='tcPrice', type=int),
+        "sell_status": 2
+        }
+
+    def records():
+        for i in xrange(100):
+            if i == 50:
+                yield {}
+            else:
+                yield {'level': {'tcPrice': str(i)}}
+
+    aml = AML()
+    results = aml.run_many(template, records())
+    assert not isinstance(results, list), 'run_many need generator'
+    for i, r in enumerate(results):
+        if i == 50:
+            assert isinstance(r, AMLRecordError), 'run_many failed %s' % r
+            assert r.index == 50 and isinstance(r.error, KeyError)
+        else:
+            assert r == {'price': i, 'sell_status': 2}, \
+                   'run_many failed index:%s result:%s' % (i, r)
+
+PARALLEL_template = {
+    "price": AMap(key='tcPrice', type=lambda x: int(x) * 2),
+    "sell_status": 2
+    }
+
+def Test_run_parallel():
+    from aml import AMLTemplateRef
+    records = [{'tcPrice': str(i)} for i in range(50)]
+    records[10] = {'tcPrice': 'x'}
+
+    aml = AML()
+    results = list(aml.run_parallel(AMLTemplateRef('Test_aml:PARALLEL_template'),
+                                    records, workers=2, chunksize=7))
+    assert len(results) == 50, 'run_parallel failed %s' % results
+    for i, r in enumerate(results):
+        if i == 10:
+            assert isinstance(r, AMLRecordError) and r.index == 10, \
+                   'run_parallel failed %s' % r
+        else:
+            assert r == {'price': i * 2, 'sell_status': 2}, \
+                   'run_parallel failed index:%s result:%s' % (i, r)
+
+    template = {"price": AMap(key='tcPrice', type=int)}
+    results = list(aml.run_parallel(aml.compile(template), iter(records[:5]),
+                                    workers=2, chunksize=2))
+    assert results == [{'price': i} for i in range(5)], \
+           'run_parallel failed %s' % results
+
+    # no worker before iterate, none left after close
+    import multiprocessing
+    results = aml.run_parallel(template, records[:5], workers=2)
+    assert not multiprocessing.active_children(), 'run_parallel pool leak'
+    assert next(results) == {'price': 0}, 'run_parallel failed'
+    results.close()
+    assert not multiprocessing.active_children(), 'run_parallel pool leak'
+
+def Test_thread_safe():
+    import threading
+    template = {
+        "amap": AMap(action=Action('location', ['level'])),
+        "title": AMap(location='level2', key='policyName', type=str),
+        "price": AMap(key='tcPrice', type=int),
+        "items": [AMap(location=['items'], action=Action('for_list', template={
+        "name": AMap(key='name')}))]
+        }
+
+    def data(i):
+        return {'level': {'level2': {'policyName': 'p%s' % i},
+                          'tcPrice': i,
+                          'items': [{'name': 'n%s' % j} for j in range(i % 5)]}}
+
+    def check_result(i):
+        return {'title': 'p%s' % i, 'price': i,
+                'items': [{'name': 'n%s' % j} for j in range(i % 5)]}
+
+    aml = AML()
+    # same instance run again
+    assert aml.run(template, data(1)) == check_result(1)
+    assert aml.run(template, data(2)) == check_result(2)
+
+    failed = []
+    def worker(n):
+        for i in range(n, n + 200):
+            r = aml.run(template, data(i))
+            if r != check_result(i):
+                failed.append((i, r))
+
+    threads = [threading.Thread(target=worker, args=(n * 1000,))
+               for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failed, 'thread safe failed %s' % failed[:3]
+
+def Test_template_cache():
+    from aml import AMLStateMachine, AMLTemplateCache
+    cache = AMLTemplateCache(capacity=16)
+    nodes = [{'k%s' % i: i} for i in range(40)]
+    for node in nodes:
+        assert cache.get(node) is None
+        cache.put(node, node.keys())
+    stats = cache.stats()
+    assert stats['size'] <= 16 and stats['evictions'] == 40 - stats['size'], \
+           'template cache evict failed %s' % stats
+    # last put is recently used
+    assert cache.get(nodes[-1]) == ['k39']
+    assert cache.get(nodes[0]) is None
+    # other node with same content is other entry
+    assert cache.get({'k39': 39}) is None
+    assert cache.hits == 1 and cache.misses == 42, cache.stats()
+
+    template = {'a': AMap(key='a'), 'b': 'b'}
+    AML().run(template, {'a': 1})
+    order_cache = AMLStateMachine.MAP_order_cache
+    hits = order_cache.hits
+    AML().run(template, {'a': 1})
+    assert order_cache.hits == hits + 1, 'AML clear template cache'
+
+def Test_deep_nesting():
+    depth = sys.getrecursionlimit() + 100
+    template = leaf = {'value': AMap(key='v')}
+    for i in range(depth):
+        template = {'next': template, 'level': i}
+
+    aml = AML()
+    r = aml.run(template, {'v': 1})
+    for i in reversed(range(depth)):
+        assert r['level'] == i, 'deep nesting failed level:%s' % i
+        r = r['next']
+    assert r == {'value': 1}, 'deep nesting failed %s' % r
+
+    template = [AMap(location='items', action=Action('for_list', template={
+        'v': AMap(key='v')}))]
+    data = {'items': [{'v': i} for i in range(10000)]}
+    r = aml.run(template, data)
+    assert r == data['items'], 'for_list failed'
+
+def Test_slots_reentrant_and_pickle():
+    import pickle
+    aml = AML()
+    sub_template = {'name': AMap(key='name')}
+    template = {
+        'sub': AMap(key='sub', type=lambda data: aml.run(sub_template, data)),
+        'items': [AMap(location='items', action=Action('for_list', template={
+        'id': AMap(key='id')}))]
+        }
+    data = {'sub': {'name': 'n'}, 'items': [{'id': 1}, {'id': 2}]}
+    check_result = {'sub': {'name': 'n'}, 'items': [{'id': 1}, {'id': 2}]}
+    for i in range(3):
+        r = aml.run(template, data)
+        assert r == check_result, 'reentrant failed %s' % r
+
+    amap = AMap(location=['a', 1], key='k',
+                action=Action('if_key', 'k', '==', 1, block_template={'a': 1}))
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        amap2 = pickle.loads(pickle.dumps(amap, protocol))
+        assert (amap2.run_idx, amap2.key, amap2.location) == \
+               (amap.run_idx, amap.key, amap.location), 'pickle failed'
+        assert amap2.action.argument_list == amap.action.argument_list
+        assert amap2.action.argument_dict == amap.action.argument_dict
+
+def Test_trace():
+    from aml import AMLStateMachine
+    template = {
+        'test': 'test',
+        'items': [AMap(location='items', action=Action('for_list', template={
+        'id': AMap(key='id')}))]
+        }
+    data = {'items': [{'id': i} for i in range(100)]}
+
+    aml = AML()
+    aml.run(template, data)
+    assert aml.trace() is None, 'trace default off'
+
+    aml = AML(trace=True, trace_size=16, trace_sample=3)
+    aml.run(template, data)
+    trace = aml.trace()
+    events = trace.events()
+    assert len(events) == 16 and trace.dropped() > 0, 'trace not bounded'
+    assert events[-1] == (1, AMLStateMachine.STATE_stop), events
+    assert trace.state_transform_list()[-1] == '1:stop'
+    assert str(trace).endswith('[1:stop]')
+
+    # 1 in 3 runs
+    last_events = trace.events()
+    aml.run(template, {'items': []})
+    aml.run(template, {'items': []})
+    assert trace.events() == last_events, 'trace sample failed'
+    aml.run(template, {'items': []})
+    events = trace.events()
+    assert events != last_events and \
+           events.count((2, AMLStateMachine.STATE_amlmap_action_for_list)) == 1, \
+           'trace sample failed %s' % events
+
+def Test_profiler():
+    import time
+    from aml import AMLProfiler
+    template = {
+        "represent_data": [
+        AMap(action=Action('location', ['level'])),
+        {
+        "price": AMap(key='tcPrice', type=int),
+        "miss": AMap(key='noKey'),
+        "items": [AMap(location=['items'], action=Action('for_list', template={
+        "name": AMap(key='name', type=lambda x: time.sleep(0.001) or str(x))}))]
+        }]
+        }
+    data = {'level': {'tcPrice': '15', 'items': [{'name': i} for i in range(10)]}}
+
+    aml = AML()
+    profiler = AMLProfiler()
+    r = aml.run(template, data, profiler=profiler)
+    assert r == aml.run(template, data), 'profile result failed'
+    report = dict((stat['path'], stat) for stat in profiler.report())
+    assert report['represent_data[1].price']['calls'] == 1
+    assert report['represent_data[1].miss']['misses'] == 1
+    assert report['represent_data[1].items[0]']['node_type'] == 'ForList'
+    name = report['represent_data[1].items[0][*].name']
+    assert name['calls'] == 10 and name['misses'] == 0 and \
+           name['type_time'] >= 0.01 and name['self_time'] >= name['type_time'], name
+    root = report['']
+    assert root['total_time'] >= report['represent_data']['total_time'] >= \
+           report['represent_data[1]']['total_time']
+    assert 0 <= root['self_time'] <= root['total_time']
+    assert 'represent_data[1].price' in str(profiler)
+
+def Test_location_path():
+    from aml import AMLPath, AMLTemplateError
+    assert AMLPath('level.items[3].price').steps == ('level', 'items', 3, 'price')
+    assert AMLPath("a['x.y'][0][-1]").steps == ('a', 'x.y', 0, -1)
+    assert AMLPath('a.b').steps == ('a', 'b')
+    assert AMLPath(['a.b', 0]).steps == ('a.b', 0)
+    assert AMLPath('a').steps == ('a',)
+    assert AMLPath('a\\.b[0]').steps == ('a.b', 0)
+    assert AMLPath('a\\[1\\].c\\\\').steps == ('a[1]', 'c\\')
+    for bad in ('.a', 'a.', 'a..b', 'a[x]', 'a[0]b', 'a\\'):
+        try:
+            AMLPath(bad)
+            assert False, 'bad path %s parsed' % bad
+        except AMLTemplateError as e:
+            assert 'Bad location path' in str(e), e
+    try:
+        AMap(location='a', root_location='b', key='k')
+        assert False, 'location and root_location'
+    except AMLTemplateError as e:
+        assert "root_location:'b'" in str(e), e
+
+    aml = AML()
+    template = {
+        'price': AMap(location='level.items[1]', key='price'),
+        'name': AMap(root_location="level['x.y']", key='name'),
+        'locate': AMap(action=Action('location', 'level.items[0]')),
+        'first': AMap(key='price'),
+        }
+    data = {'level': {'items': [{'price': 1}, {'price': 2}],
+                      'x.y': {'name': 'n'}}}
+    check_result = {'price': 2, 'name': 'n', 'first': 1}
+    r = aml.run(template, data)
+    assert r == check_result, 'location path failed %s' % r
+    for backend in ('plan', 'codegen'):
+        r = aml.compile(template, backend=backend).run(data)
+        assert r == check_result, '%s location path failed %s' % (backend, r)
+
+    # literal key with '.', escape it or quote it
+    template = {
+        'escape': AMap(location='a\\.b', key='k'),
+        'quote': AMap(location="['a.b']", key='k'),
+        'list': AMap(location=['a.b'], key='k'),
+        }
+    data = {'a.b': {'k': 1}, 'a': {'b': {'k': 2}}}
+    check_result = {'escape': 1, 'quote': 1, 'list': 1}
+    r = aml.run(template, data)
+    assert r == check_result, 'literal dot key failed %s' % r
+    for backend in ('plan', 'codegen'):
+        r = aml.compile(template, backend=backend).run(data)
+        assert r == check_result, '%s literal dot key failed %s' % (
+            backend, r)
+
+def Test_run_stream():
+    import io
+    import json
+    from aml import AMLTemplateError, AMLDataError
+    aml = AML()
+    item_template = {
+        'id': AMap(key='id'),
+        'price': AMap(key='price', type=float),
+        'shop': AMap(root_location='meta', key='name'),
+        'count': AMap(root_location='level', key='count'),
+        }
+    template = {
+        'meta': AMap(key='meta'),
+        'items': [AMap(location='level.items',
+                       action=Action('for_list', template=item_template))]
+        }
+    items = b'[{"id": 0, "price": 0.0}, {"id": 1, "price": 1.5}, ' \
+            b'{"id": 2, "price": 3.0}]'
+    # root data before and after the array
+    text = b'{"meta": {"name": "shop"}, "level": {"count": 3, "items": ' + \
+           items + b', "after": [1, 2]}}'
+    after_text = b'{"level": {"count": 3, "items": ' + items + \
+                 b', "after": [1, 2]}, "meta": {"name": "shop"}}'
+    check_result = aml.run(template, json.loads(text))['items']
+    assert check_result[0] == {'id': 0, 'price': 0.0, 'shop': 'shop',
+                               'count': 3}, check_result
+    for chunk_size in (1, 7, 65536):
+        r = list(aml.run_stream(template, io.BytesIO(text), chunk_size=chunk_size))
+        assert r == check_result, 'run_stream failed %s %s' % (chunk_size, r)
+    try:
+        list(aml.run_stream(template, io.BytesIO(after_text)))
+        assert 0, 'run_stream read data after the array'
+    except AMLTemplateError:
+        pass
+    after_template = {'items': [AMap(location='level.items', action=Action(
+        'for_list', template={'after': AMap(root_location='level',
+                                            key='after')}))]}
+    try:
+        list(aml.run_stream(after_template, io.BytesIO(text)))
+        assert 0, 'run_stream read data after the array'
+    except AMLTemplateError:
+        pass
+
+    r = list(aml.run_stream(template, io.BytesIO(b'{"level": {"items": []}}')))
+    assert r == [], 'run_stream empty failed %s' % r
+    # malformed document, document without the array
+    for bad, error in ((b'{"level" {"items": []}}', ValueError),
+                       (b'{"level": {"items": [{"id": 1} {"id": 2}]}}',
+                        ValueError),
+                       (b'{"level": {"items": [{"id": 1}', ValueError),
+                       (b'{"level": {"other": []}}', AMLDataError)):
+        try:
+            list(aml.run_stream(template, io.BytesIO(bad)))
+            assert 0, 'run_stream malformed document %s' % bad
+        except error as e:
+            assert 'json stream' in str(e) or error is ValueError, e
+    template['others'] = [AMap(location='meta', action=Action(
+        'for_list', template={'id': AMap(key='id')}))]
+    r = list(aml.run_stream(template, io.BytesIO(text), path='level.items'))
+    assert r == check_result, 'run_stream path failed %s' % r
+
+def Test_dump():
+    import json
+    class Writer(object):
+        def __init__(self):
+            self.chunks = []
+        def write(self, text):
+            self.chunks.append(text)
+    aml = AML()
+    template = {
+        'name': AMap(key='name'),
+        'static': {'a': [1, 'x']},
+        'last': AMap(location='items', action=Action('for_list', template={
+            'id': AMap(key='id')})),
+        'items': [0, AMap(location='items', action=Action('for_list', template={
+            'id': AMap(key='id'), 'v': AMap(action=Action(
+            'if_key', 'id', '>', 0, block_template={'big': True}))}))]
+        }
+    data = {'name': 'n', 'items': [{'id': i} for i in range(3)]}
+    fp = Writer()
+    aml.dump(template, data, fp)
+    r = json.loads(''.join(fp.chunks))
+    assert r == json.loads(json.dumps(aml.run(template, data))), 'dump failed %s' % r
+    # flush every list for_list item
+    assert len(fp.chunks) == 4, 'dump no flush item %s' % fp.chunks
+    assert ''.join(fp.chunks[:1]).endswith('[0, {"id": 0}'), fp.chunks
+
+    compiled = aml.compile(template)
+    fp = Writer()
+    compiled.dump({'name': 'm', 'items': []}, fp)
+    assert json.loads(''.join(fp.chunks)) == \
+           {'name': 'm', 'static': {'a': [1, 'x']}, 'items': [0]}, fp.chunks
+
+def Test_run_lazy():
+    from aml import AMLLazyView
+    calls = []
+    def price(value):
+        calls.append(value)
+        return value * 2
+    aml = AML()
+    template = {
+        'amap': AMap(action=Action('location', 'level')),
+        'name': AMap(key='name'),
+        'items': [AMap(location='items', action=Action('for_list', template={
+            'price': AMap(key='price', type=price)}))],
+        'if': AMap(key='name', action=Action('if_key', 'name', '==', 'x',
+                                             block_template={'a': 1})),
+        }
+    data = {'level': {'name': 'n', 'items': [{'price': i} for i in range(4)]}}
+    r = aml.run_lazy(template, data)
+    assert r['name'] == 'n', 'lazy location failed %s' % r['name']
+    assert calls == [], 'lazy evaluate eager %s' % calls
+    assert r['items'][2]['price'] == 4 and calls == [2], calls
+    assert r['items'][2]['price'] == 4 and calls == [2], 'lazy no cache'
+    assert len(r['items']) == 4 and 'if' not in r and len(r) == 2
+    try:
+        r['name'] = 1
+        assert False, 'lazy view is writable'
+    except TypeError:
+        pass
+    assert r == aml.run(template, data), 'lazy failed %s' % r
+    assert AMLLazyView.materialize(r) == aml.run(template, data)
+
+def Test_run_columns():
+    import array
+    aml = AML()
+    template = {
+        'meta': AMap(key='meta'),
+        'items': [AMap(location='items', action=Action('for_list', template={
+            'id': AMap(key='id', type=int),
+            'price': AMap(key='price', type=float),
+            'name': AMap(key='name'),
+            'second': AMap(index=1),
+            'kind': 'item'}))]
+        }
+    data = {'meta': 1, 'items': [{'id': 1, 'price': 2, 'name': 'a'},
+                                 {'id': 2, 'price': 3}]}
+    r = aml.run(template, data)
+    assert aml.compile(template).run(data) == r, 'flat for_list failed'
+    columns = aml.run_columns(template, data, use_numpy=False)
+    assert columns['id'] == array.array('l', [1, 2]), columns['id']
+    assert columns['price'] == array.array('d', [2.0, 3.0])
+    assert columns['name'] == ['a', None], columns['name']
+    assert columns['second'] == [None] * 2 and columns['kind'] == ['item'] * 2
+    rows = [dict((key, columns[key][i]) for key in columns) for i in range(2)]
+    assert rows == r['items'], 'columns failed %s' % rows
+    from aml import AMLTemplateError
+    for bad_template, path in (
+        ({'items': [AMap(location='items', action=Action('for_list', template={
+            'nested': {'id': AMap(key='id')}}))]}, None),
+        (template, 'miss')):
+        try:
+            aml.run_columns(bad_template, data, path)
+            assert False, 'run_columns of bad template %s' % path
+        except AMLTemplateError:
+            pass
+    try:
+        import numpy
+    except ImportError:
+        return
+    columns = aml.run_columns(template, data)
+    assert isinstance(columns['price'], numpy.ndarray), columns['price']
+    assert columns['price'].tolist() == [2.0, 3.0]
+
+def Test_run_incremental():
+    calls = []
+    def price(value):
+        calls.append(value)
+        return value
+    aml = AML()
+    template = {
+        'amap': AMap(action=Action('location', 'level')),
+        'count': AMap(key='count'),
+        'items': [AMap(location='items', action=Action('for_list', template={
+            'id': AMap(key='id'), 'price': AMap(key='price', type=price)}))]
+        }
+    data = {'level': {'count': 3,
+                      'items': [{'id': i, 'price': i * 10} for i in range(3)]}}
+    incremental = aml.run_incremental(template, data)
+    assert incremental.result == aml.run(template, data), incremental.result
+
+    del calls[:]
+    data['level']['items'][1]['price'] = 99
+    changed = incremental.update(['level.items[1].price'])
+    assert changed == set(['items[1].price']), 'changed failed %s' % changed
+    assert calls == [99], 'recompute not only affected %s' % calls
+    assert incremental.result == aml.run(template, data), incremental.result
+
+    data['level']['items'].append({'id': 3, 'price': 30})
+    data['level']['count'] = 4
+    changed = incremental.update(['level.items', 'level.count'])
+    assert changed == set(['items', 'count']), 'changed failed %s' % changed
+    assert incremental.result == aml.run(template, data), incremental.result
+    assert incremental.update(['other']) == set()
+
+def Test_read_set_and_load_json():
+    import io
+    import json
+    aml = AML()
+    template = {
+        'amap': AMap(action=Action('location', 'level')),
+        'name': AMap(key='name'),
+        'items': [AMap(location='items', action=Action('for_list', template={
+            'price': AMap(key='price'),
+            'if': AMap(action=Action('if_key', 'kind', '==', 'a',
+                                     block_template={'tag': AMap(key='tag')}))
+            }))]
+        }
+    read_set = str(aml.read_set(template))
+    for path in ('level.name', 'level.items[*].price', 'level.items[*].kind',
+                 'level.items[*].tag'):
+        assert path in read_set.split('\n'), 'read set failed %s' % read_set
+
+    data = {'other': {'big': list(range(100))}, 'level': {
+        'name': 'n', 'unused': [1, 2],
+        'items': [{'price': 1, 'kind': 'a', 'tag': 't', 'unused': 'x' * 100},
+                  {'kind': 'b', 'unused': 2}]}}
+    text = json.dumps(data).encode('utf-8')
+    for chunk_size in (1, 65536):
+        loaded = aml.load_json(template, io.BytesIO(text), chunk_size)
+        assert 'other' not in loaded and 'unused' not in loaded['level'], loaded
+        assert loaded['level']['items'][0] == {'price': 1, 'kind': 'a',
+                                               'tag': 't'}, loaded
+        assert loaded['level']['items'][1] == {'kind': 'b'}, loaded
+        assert aml.run(template, loaded) == aml.run(template, data)
+    for bad in (b'{"level" {"name": "n"}}', b'{"level": {"name": "n",}}',
+                b'{"level": {"items": [1 2]}}', b'{"level": {"name": "n"'):
+        try:
+            aml.load_json(template, io.BytesIO(bad))
+            assert 0, 'load_json malformed document %s' % bad
+        except ValueError:
+            pass
+    # truth value of dict keep
+    r = aml.read_set({'a': AMap(key='a')}).project({'b': {'c': 1}})
+    assert r == {'b': None}, 'project failed %s' % r
+
+def Test_error_collector():
+    from aml import AMLErrorCollector, AMLMapError
+    aml = AML()
+    template = {
+        'name': AMap(key='name'),
+        'miss': AMap(key='miss'),
+        'list': [AMap(location='items', index=5)],
+        'items': [AMap(location='items', action=Action('for_list', template={
+            'id': AMap(key='id')}))]
+        }
+    data = {'name': 'n', 'items': [{'id': 1}, {'x': 'x' * 1000}]}
+    for run in (lambda errors: aml.run(template, data, errors=errors),
+                lambda errors: aml.compile(template).run(data, errors),
+                lambda errors: aml.compile(template, 'codegen').run(data, errors)):
+        errors = AMLErrorCollector()
+        r = run(errors)
+        assert r['items'] == [{'id': 1}, {'id': None}], r
+        assert errors.total == 3, errors
+        assert sorted(errors.events) == sorted([
+            ('map_index', 'list[0]', 5, 'list'),
+            ('map_key', 'items[0][*].id', 'id', 'dict'),
+            ('map_key', 'miss', 'miss', 'dict')]), errors.events
+        assert errors.counts[('map_key', 'miss')] == 1, errors.counts
+
+    # strict fail fast, machine can run again
+    try:
+        aml.run(template, data, errors=AMLErrorCollector(strict=True))
+        assert False, 'strict no raise'
+    except AMLMapError as e:
+        assert e.event.kind in ('map_key', 'map_index'), e
+    assert aml.run({'name': AMap(key='name')}, data) == {'name': 'n'}
+
+    # rate limited log
+    errors = AMLErrorCollector(max_events=1, log=True, log_rate=2)
+    for i in range(5):
+        aml.run({'miss': AMap(key='miss')}, data, errors=errors)
+    assert errors.total == 5 and len(errors.events) == 1, errors
+    assert errors.suppressed <= 3, errors.suppressed
+
+def Test_action_parsed_once():
+    import io
+    from aml import AMLTemplateError, AMLDataError
+    aml = AML()
+    # bad argument fail at compile, before any data
+    bad = {'x': AMap(action=Action('if_key', 'a', '<>', 1, block_template={}))}
+    for run in (lambda: aml.compile(bad), lambda: aml.run(bad, {'a': 1})):
+        try:
+            run()
+            assert False, 'bad op no raise'
+        except AMLTemplateError as e:
+            assert '<>' in str(e), e
+
+    action = Action('for_list', template={'id': AMap(key='id')})
+    template = {'items': AMap(location='items', action=action)}
+    assert action.parsed() is action.parsed(), 'action parsed twice'
+    data = {'items': {'id': 1}}
+    for run in (lambda: aml.run(template, data),
+                lambda: aml.compile(template).run(data),
+                lambda: aml.compile(template, 'codegen').run(data),
+                lambda: aml.dump(template, data, io.BytesIO()),
+                lambda: aml.run_incremental(template, data)):
+        try:
+            run()
+            assert False, 'for_list dict no raise'
+        except AMLDataError as e:
+            assert 'dict' in str(e), e
+    assert aml.run(template, {'items': [{'id': 1}]}) == {'items': {'id': 1}}
+
+def Test_switch_key():
+    import io, json
+    from aml import AMLTemplateError
+    aml = AML()
+    paid = {'state': 'paid', 'amount': AMap(key='amount')}
+    cases = dict((code, {'state': 'code %s' % code}) for code in range(50))
+    cases.update({1: paid, 2: paid, 3: None, 'x': 'lit'})
+    template = {
+        'order': AMap(action=Action('switch_key', 'status', cases=cases,
+                                    default={'state': 'unknow'})),
+        'list': [AMap(action=Action('switch_key', 'status', cases=cases))]
+        }
+    expects = [
+        ({'status': 2, 'amount': 9}, {'order': {'state': 'paid', 'amount': 9},
+                                      'list': [{'state': 'paid', 'amount': 9}]}),
+        ({'status': 30}, {'order': {'state': 'code 30'},
+                          'list': [{'state': 'code 30'}]}),
+        ({'status': 'x'}, {'order': 'lit', 'list': ['lit']}),
+        ({'status': 3}, {'list': []}),
+        ({'status': 99}, {'order': {'state': 'unknow'}, 'list': []}),
+        ({'status': [1]}, {'order': {'state': 'unknow'}, 'list': []}),
+        ]
+    for data, expect in expects:
+        for run in (lambda: aml.run(template, data),
+                    lambda: aml.compile(template).run(data),
+                    lambda: aml.compile(template, 'codegen').run(data)):
+            r = run()
+            assert r == expect, 'switch_key %s: %s != %s' % (data, r, expect)
+        fp = io.BytesIO()
+        aml.dump(template, data, fp)
+        assert json.loads(fp.getvalue()) == expect, fp.getvalue()
+
+    # same case template compile once
+    plan = aml.compile(template).plan
+    switch = dict(plan.children)['order']
+    assert switch._cases[1] is switch._cases[2], 'case node not shared'
+
+    try:
+        aml.compile({'x': AMap(action=Action('switch_key', 'status'))})
+        assert False, 'switch_key without cases no raise'
+    except AMLTemplateError as e:
+        assert 'cases' in str(e), e
+
+def Test_lookup():
+    import io, json
+    from aml import AMLDataError, AMLRunCache, Action_Lookup, AMLLazyView
+    aml = AML()
+    data = {
+        'products': [{'id': 1, 'name': 'pen'}, {'id': 2, 'name': 'ink'},
+                     {'id': 2, 'name': 'ink2'}, 'bad row', {'name': 'no id'}],
+        'orders': [{'pid': 2, 'n': 3}, {'pid': 9, 'n': 1}, {'n': 0}]
+        }
+    def template(**kwargs):
+        return {'orders': [AMap(location='orders', action=Action('for_list', template={
+            'n': AMap(key='n'),
+            'product': AMap(action=Action('lookup', 'products', 'id', 'pid',
+                                          **kwargs))}))]}
+    product = {'name': AMap(key='name')}
+    expect = {'orders': [{'n': 3, 'product': {'name': 'ink'}},
+                         {'n': 1, 'product': None}, {'n': 0, 'product': None}]}
+    run_list = (lambda t: aml.run(t, data),
+                lambda t: aml.compile(t).run(data),
+                lambda t: aml.compile(t, 'codegen').run(data),
+                lambda t: AMLLazyView.materialize(aml.run_lazy(t, data)),
+                lambda t: aml.run_incremental(t, data).result)
+    for run in run_list:
+        r = run(template(template=product))
+        assert r == expect, 'lookup failed %s' % r
+        r = run(template(missing='skip', duplicate='last'))
+        assert r['orders'][0]['product'] is data['products'][2], r
+        assert r['orders'][1] == {'n': 1}, r
+        for kwargs in ({'missing': 'error'}, {'duplicate': 'error'}):
+            try:
+                run(template(**kwargs))
+                assert False, 'lookup %s no raise' % kwargs
+            except AMLDataError as e:
+                assert 'products' in str(e), e
+    fp = io.BytesIO()
+    aml.dump(template(template=product), data, fp)
+    assert json.loads(fp.getvalue()) == expect, fp.getvalue()
+
+    # index build once of a run
+    builds = []
+    build = Action_Lookup._build
+    Action_Lookup._build = lambda self, table: builds.append(1) or \
+                           build(self, table)
+    try:
+        aml.compile(template(template=product)).run(data)
+    finally:
+        Action_Lookup._build = build
+    assert len(builds) == 1, 'index build %s times' % len(builds)
+    assert AMLRunCache.current() is None, 'run cache not restore'
+
+    # incremental rerun the lookup of the table change
+    incremental = aml.run_incremental(template(template=product), data)
+    data['products'][1]['name'] = 'blue ink'
+    incremental.update(['products[1].name'])
+    assert incremental.result['orders'][0]['product'] == {'name': 'blue ink'}, \
+           incremental.result
+    # table row read key field and template field only
+    paths = set(aml.read_set(template(template=product)).paths())
+    assert paths >= set([(('orders', '*', 'pid'), True),
+                         (('products', '*', 'id'), True),
+                         (('products', '*', 'name'), True)]), paths
+    assert not [path for path, _ in paths if path[:2] == ('products', '*') and
+                len(path) == 2], paths
+
+    # bad table path is template error of the action
+    from aml import AMLTemplateError
+    try:
+        Action('lookup', 'products[x', 'id', 'pid').parsed()
+        assert False, 'lookup bad table path parsed'
+    except AMLTemplateError as e:
+        assert 'Bad location path' in str(e) and 'lookup' in str(e), e
+
+def Test_memo():
+    data = {'shop': {'name': 'shop', 'city': 'x'},
+            'items': [{'id': 1}, {'id': 2}, {'id': 3}]}
+    header = {'amap': AMap(action=Action('root_location', 'shop')),
+              'name': AMap(key='name'), 'city': AMap(key='city')}
+    template = {'items': [AMap(location='items', action=Action('for_list', template={
+        'id': AMap(key='id'), 'header': header}))]}
+    expect = {'items': [{'id': i, 'header': {'name': 'shop', 'city': 'x'}}
+                        for i in (1, 2, 3)]}
+    for memo_size, shared in ((0, False), (1000, True)):
+        aml = AML(memo_size=memo_size)
+        for run in (lambda: aml.run(template, data),
+                    lambda: aml.compile(template).run(data),
+                    lambda: aml.compile(template, 'codegen').run(data)):
+            r = run()
+            assert r == expect, 'memo run failed %s' % r
+            headers = [item['header'] for item in r['items']]
+            assert (headers[0] is headers[2]) is shared, \
+                   'memo_size %s header shared %s' % (memo_size, not shared)
+
+    # memo of a run, not across runs
+    aml = AML(memo_size=1000)
+    compiled = aml.compile(template)
+    first = compiled.run(data)['items'][0]['header']
+    data['shop']['name'] = 'new'
+    assert compiled.run(data)['items'][0]['header'] == {
+        'name': 'new', 'city': 'x'}, 'memo of other run'
+    assert aml.run(template, data)['items'][0]['header']['name'] == 'new'
+    assert first['name'] == 'shop'
+
+    # cap of memo result, over cap is evaluate
+    template = {'items': [AMap(location='items', action=Action('for_list', template={
+        'row': {'id': AMap(key='id')}, 'header': header}))]}
+    for run in (lambda: AML(memo_size=1).run(template, data),
+                lambda: AML(memo_size=1).compile(template).run(data)):
+        r = run()
+        assert [item['row'] for item in r['items']] == [
+            {'id': 1}, {'id': 2}, {'id': 3}], r
+        assert r['items'][2]['header']['name'] == 'new', r
+
+    # memo container only in for_list item, all engine same sharing
+    sub = {'v': AMap(key='v')}
+    template = {'a': sub, 'b': sub}
+    aml = AML(memo_size=10)
+    for run in (lambda: aml.run(template, {'v': 1}),
+                lambda: aml.compile(template).run({'v': 1}),
+                lambda: aml.compile(template, 'codegen').run({'v': 1})):
+        r = run()
+        assert r == {'a': {'v': 1}, 'b': {'v': 1}}, r
+        assert r['a'] is not r['b'], 'memo out of for_list'
+
+    # memo of run_stream is one item, item data is free after the item
+    import io, json
+    items = [{'id': i, 'sub': {'v': i}} for i in range(2000)]
+    document = json.dumps({'items': items})
+    template = {'items': [AMap(location='items', action=Action('for_list',
+        template=[AMap(action=Action('location', 'sub')), AMap(key='v')]))]}
+    aml = AML(memo_size=10000)
+    for backend in ('plan', 'codegen'):
+        compiled = aml.compile(template, backend)
+        r = list(aml.run_stream(compiled, io.BytesIO(document)))
+        assert r == [[i] for i in range(2000)], \
+               '%s run_stream memo failed %s' % (backend, r[:10])
+
+
+def Test_static_fold():
+    import io, json
+    static = {'a': [1, 'x', True, {'b': 1.5}], 'c': {}}
+    template = {'name': AMap(key='name'), 'static': static,
+                'items': [AMap(location='items', action=Action('for_list',
+                                                               template=static))]}
+    data = {'name': 'n', 'items': [1, 2]}
+    expect = {'name': 'n', 'static': static, 'items': [static, static]}
+    for share_static in (False, True):
+        aml = AML(share_static=share_static)
+        for run in (lambda: aml.run(template, data),
+                    lambda: aml.compile(template).run(data),
+                    lambda: aml.compile(template, 'codegen').run(data)):
+            r1, r2 = run(), run()
+            assert r1 == expect, 'static fold failed %s' % r1
+            assert (r1['static'] is r2['static']) is share_static, \
+                   'share_static %s result shared %s' % (share_static,
+                                                         not share_static)
+            assert r1['static']['a'] is not static['a'], 'template shared'
+        r1, r2 = aml.run(static, data), aml.run(static, data)
+        assert r1 == static and (r1 is r2) is share_static, r1
+
+    # copy of every run, change result not change the next run
+    r = AML().compile(template).run(data)
+    r['static']['a'].append(2)
+    assert AML().run(template, data) == expect, 'static copy changed'
+
+    fp = io.BytesIO()
+    AML().dump(template, data, fp)
+    assert json.loads(fp.getvalue()) == expect, fp.getvalue()
+    # static item read only the list
+    paths = AML().compile(template).read_set().paths()
+    assert paths == [(('items',), False), (('name',), True)], paths
+
+    # static sub-template is not walk
+    trace = AML(trace=True)
+    trace.run(template, data)
+    states = trace.trace().state_transform_list()
+    assert states.count('1:type_static') == 1 and \
+           states.count('2:type_static') == 2, states
+    assert '2:type_number' not in states, states
+
+def Test_template_registry():
+    import os, shutil, tempfile
+    from aml import AMLTemplateRegistry, AMLTemplateError
+    data = {'name': 'n', 'items': [{'id': 1}, {'id': 2}]}
+    def make(version):
+        return {'name': AMap(key='name'), 'version': version,
+                'ids': [AMap(location='items', action=Action('for_list',
+                                                             template={'id': AMap(key='id')}))]}
+    cache_dir = tempfile.mkdtemp()
+    try:
+        registry = AMLTemplateRegistry(backend='codegen', cache_dir=cache_dir)
+        registry.register('shop', make(1), version=1)
+        registry.register('shop', make(2), version=2)
+        registry.register('plain', {'a': AMap(key='name')}, backend='plan')
+        try:
+            registry.register('shop', make(2), version=2)
+            assert 0, 'register same version'
+        except AMLTemplateError:
+            pass
+        assert registry.warm_up() == 3 and registry.warm_up() == 0
+        assert registry.run('shop', data) == {'name': 'n', 'version': 2,
+                                              'ids': data['items']}
+        assert registry.get('shop', 1).run(data)['version'] == 1
+        assert registry.get('plain').source is None
+        assert registry.code_cache.stats() == {'hits': 0, 'misses': 2,
+                                               'errors': 0}
+        assert len(os.listdir(cache_dir)) == 2, os.listdir(cache_dir)
+
+        # new process load bytecode of the cache
+        registry = AMLTemplateRegistry(backend='codegen', cache_dir=cache_dir)
+        registry.register('shop', make(2), version=2)
+        registry.warm_up()
+        assert registry.code_cache.hits == 1, registry.code_cache
+        assert registry.run('shop', data)['ids'] == data['items']
+
+        # bad file is a miss
+        for file_name in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, file_name), 'wb') as fp:
+                fp.write('bad')
+        registry = AMLTemplateRegistry(backend='codegen', cache_dir=cache_dir)
+        registry.register('shop', make(2), version=2)
+        assert registry.run('shop', data)['version'] == 2
+        assert registry.code_cache.misses == 1, registry.code_cache
+        try:
+            registry.get('miss')
+            assert 0, 'get not registered'
+        except AMLTemplateError:
+            pass
+    finally:
+        shutil.rmtree(cache_dir)
+
+def Test_empty_branch():
+    aml = AML()
+    data = {'k': 1}
+    for empty in ({}, []):
+        for amap in (AMap(action=Action('if_key', 'k', '==', 1,
+                                        block_template=empty,
+                                        else_template='else')),
+                     AMap(action=Action('switch_key', 'k',
+                                        cases={1: empty}))):
+            template = {'x': amap}
+            for run in (lambda: aml.run(template, data),
+                        lambda: aml.compile(template).run(data),
+                        lambda: aml.compile(template, 'codegen').run(data)):
+                r = run()
+                assert r == {'x': empty}, 'empty branch %r failed %s' % (
+                    empty, r)
@@ -9,8 +9,543 @@
 # AML -- Assembly&Map Language
 #
 
+import array
+import codecs
+import collections
 import copy
+import hashlib
+import imp
+import importlib
+import itertools
+import json
 import logging
+import marshal
+import multiprocessing
+import operator
+import os
+import re
+import tempfile
+import threading
+import timeit
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class AMLTemplateCache(object):
+    """
+    process wide bounded cache of template node prepare result
+
+      key is id(node), entry keep the node alive, so the id is
+      not reuse by other node while the entry in cache
+      LRU evict when size over capacity, get is lock free
+      counters: hits, misses, evictions
+    """
+
+    def __init__(self, capacity=4096):
+        assert capacity > 0, 'cache capacity need > 0'
+        self.capacity = capacity
+        # id(node) -> [node, value, tick]
+        self._entries = {}
+        self._tick = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, node, default=None):
+        entry = self._entries.get(id(node))
+        if entry is not None and entry[0] is node:
+            entry[2] = next(self._tick)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return default
+
+    def put(self, node, value):
+        with self._lock:
+            self._entries[id(node)] = [node, value, next(self._tick)]
+            if len(self._entries) > self.capacity:
+                self._evict()
+
+    def _evict(self):
+        # evict to 7/8 capacity, a scan for many put
+        keep = self.capacity - self.capacity // 8
+        entries = self._entries.items()
+        entries.sort(key=lambda x: x[1][2])
+        for key, entry in entries[:len(entries) - keep]:
+            del self._entries[key]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __str__(self):
+        return '<AMLTemplateCache at 0x%x %s>' % (id(self), self.stats())
+
+    __repr__ = __str__
+
+
+class AMLStaticLiteral(object):
+    """
+    static template node, dict and list of string, number and bool
+    without AMLMap, prebuilt once of the template
+
+      literal: the prebuilt node, shared by every run of share_static
+      build(): new deep copy of literal, one python literal expression
+      source: the expression, None if it need constant of namespace
+      cached by AMLStateMachine.cached_static, template is not changed
+      after the first run, same as the map order
+    """
+
+    __slots__ = ('literal', 'source', 'build')
+
+    # value of repr is the same value
+    REPR_types = (str, unicode, bool, int, long)
+    SCALAR_types = (basestring, bool, int, long, float)
+    # deeper node is deepcopy, python parser limit
+    MAX_depth = 32
+
+    def __init__(self, template):
+        namespace = {'_deepcopy': copy.deepcopy}
+        source = self._source(template, namespace, 0)
+        self.source = source if len(namespace) == 1 else None
+        self.build = eval('lambda: ' + source, namespace)
+        self.literal = self.build()
+
+    @staticmethod
+    def compile(template):
+        """
+        AMLStaticLiteral of template, None is not static
+        """
+        if not isinstance(template, (dict, list)):
+            return None
+        try:
+            if not AMLStaticLiteral.is_static(template):
+                return None
+        except RuntimeError:
+            # too deep, walk by state machine
+            return None
+        return AMLStaticLiteral(template)
+
+    @staticmethod
+    def is_static(node):
+        if isinstance(node, dict):
+            return all(AMLStaticLiteral.is_static(value)
+                       for value in node.itervalues())
+        elif isinstance(node, list):
+            return all(AMLStaticLiteral.is_static(value) for value in node)
+        return isinstance(node, AMLStaticLiteral.SCALAR_types)
+
+    @staticmethod
+    def _source(node, namespace, depth):
+        if isinstance(node, (dict, list)) and \
+           depth >= AMLStaticLiteral.MAX_depth:
+            return '_deepcopy(%s)' % AMLStaticLiteral._const(node, namespace)
+        if isinstance(node, dict):
+            return '{%s}' % ', '.join(
+                '%s: %s' % (AMLStaticLiteral._scalar(key, namespace),
+                            AMLStaticLiteral._source(value, namespace,
+                                                     depth + 1))
+                for key, value in node.iteritems())
+        elif isinstance(node, list):
+            return '[%s]' % ', '.join(
+                AMLStaticLiteral._source(value, namespace, depth + 1)
+                for value in node)
+        return AMLStaticLiteral._scalar(node, namespace)
+
+    @staticmethod
+    def _scalar(value, namespace):
+        if type(value) in AMLStaticLiteral.REPR_types or \
+           (type(value) is float and value == value and
+            value not in (float('inf'), float('-inf'))):
+            return repr(value)
+        # nan, inf and subclass is constant
+        return AMLStaticLiteral._const(value, namespace)
+
+    @staticmethod
+    def _const(value, namespace):
+        name = '_k%s' % len(namespace)
+        namespace[name] = value
+        return name
+
+
+class AMLError(Exception):
+    """
+    base of AML error
+    """
+
+
+class AMLTemplateError(AMLError, ValueError):
+    """
+    invalid template, action argument check failed
+    """
+
+
+class AMLDataError(AMLError, TypeError):
+    """
+    data not fit the action, if_key key not in data, for_list data is
+    not list
+    """
+
+
+AMLMissEvent = collections.namedtuple('AMLMissEvent',
+                                      'kind path missing data_type')
+
+
+class AMLMapError(AMLError, LookupError):
+    """
+    map miss of strict AMLErrorCollector
+    """
+
+    def __init__(self, event):
+        super(AMLMapError, self).__init__(event)
+        self.event = event
+
+    def __str__(self):
+        return "%s '%s' miss %r of %s data" % self.event
+
+
+class AMLErrorCollector(object):
+    """
+    structured event of map_key, map_index miss, no repr of the data
+
+      event: AMLMissEvent(kind, path, missing, data_type)
+        kind: 'map_key' or 'map_index'
+        path: template path of the amap, same as plan node path
+        missing: the key or index
+        data_type: type name of the data
+      counts: {(kind, path): number}, total: number of miss
+      max_events: events keep the first max_events
+      log: logging.error the event, at most log_rate per second, the
+           suppressed number is log with the next one
+      strict: raise AMLMapError of the first miss
+    """
+
+    KIND_map_key = 'map_key'
+    KIND_map_index = 'map_index'
+
+    # thread current collector of plan node
+    _local = threading.local()
+
+    def __init__(self, strict=False, max_events=1000, log=False, log_rate=10):
+        self.strict = strict
+        self.max_events = max_events
+        self.log = log
+        self.log_rate = log_rate
+        self.events = []
+        self.counts = collections.Counter()
+        self.total = 0
+        self.suppressed = 0
+        self._log_second = None
+        self._log_count = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def current():
+        """
+        collector of the running AMLTemplate.run of the thread, or the
+        process default (log only)
+        """
+        errors = getattr(AMLErrorCollector._local, 'errors', None)
+        return errors if errors is not None else AMLErrorCollector.default
+
+    @staticmethod
+    def set_current(errors):
+        """
+        return the previous one to restore
+        """
+        previous = getattr(AMLErrorCollector._local, 'errors', None)
+        AMLErrorCollector._local.errors = errors
+        return previous
+
+    def miss(self, kind, path, missing, data):
+        event = AMLMissEvent(kind, path, missing, type(data).__name__)
+        with self._lock:
+            self.total += 1
+            self.counts[(kind, path)] += 1
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+        if self.strict:
+            raise AMLMapError(event)
+        if self.log:
+            self._log(event)
+
+    def _log(self, event):
+        second = int(timeit.default_timer())
+        with self._lock:
+            if second != self._log_second:
+                self._log_second = second
+                self._log_count = 0
+            self._log_count += 1
+            if self._log_count > self.log_rate:
+                self.suppressed += 1
+                return
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            logging.error("%s '%s' miss %r of %s data (%s suppressed)",
+                          *(event + (suppressed,)))
+        else:
+            logging.error("%s '%s' miss %r of %s data", *event)
+
+    def clear(self):
+        with self._lock:
+            del self.events[:]
+            self.counts.clear()
+            self.total = 0
+            self.suppressed = 0
+
+    def __str__(self):
+        return '\n'.join(["<AMLErrorCollector at 0x%x total:%s>" % (
+                          id(self), self.total)] +
+                         ["%8d  %s '%s'" % (count, kind, path)
+                          for (kind, path), count in
+                          self.counts.most_common()])
+
+    __repr__ = __str__
+
+AMLErrorCollector.default = AMLErrorCollector(max_events=0, log=True)
+
+
+class AMLRunCache(object):
+    """
+    cache of one run, shared by the node of the run, drop with the run
+
+      indexes: {(id(table), key_field, duplicate): index} of lookup,
+               the table is alive in the run data, id is stable
+      memo: {(sub-template, id(data)): (data, result)} of memo
+            container, at most memo_size, 0 is no memo, the data is
+            keep alive so the id is not reuse, see Plan_Memo
+    """
+
+    __slots__ = ('indexes', 'memo', 'memo_size')
+
+    # thread current cache of plan node
+    _local = threading.local()
+
+    def __init__(self, memo_size=0):
+        self.indexes = {}
+        self.memo = {}
+        self.memo_size = memo_size
+
+    @staticmethod
+    def current():
+        """
+        cache of the running template of the thread, None is no cache
+        """
+        return getattr(AMLRunCache._local, 'cache', None)
+
+    @staticmethod
+    def set_current(cache):
+        """
+        return the previous one to restore
+        """
+        previous = getattr(AMLRunCache._local, 'cache', None)
+        AMLRunCache._local.cache = cache
+        return previous
+
+    def run(self, function, *args):
+        """
+        function(*args) with the cache as current
+        """
+        previous = AMLRunCache.set_current(self)
+        try:
+            return function(*args)
+        finally:
+            AMLRunCache.set_current(previous)
+
+    def iterate(self, iterator, item_memo=False):
+        """
+        iterator with the cache as current, item by item
+        item_memo: memo of one item, clear before the next, item data
+                   is free after the item
+        """
+        while True:
+            if item_memo:
+                self.memo.clear()
+            previous = AMLRunCache.set_current(self)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                AMLRunCache.set_current(previous)
+            yield item
+
+
+class AMLFrame(object):
+    """
+    saved parent level state of AMLStateMachine frame stack,
+    reuse by frame pool of the state machine
+    """
+    __slots__ = ('level', 'template', 'global_cur_data', 'result',
+                 'struct_type', 'last_state', 'dict_stack', 'dict_idx',
+                 'dict_key', 'list_size', 'list_idx', 'for_iter',
+                 'memo_key')
+
+
+class AMLTraceBuffer(object):
+    """
+    bounded ring buffer of state transform event of one run
+
+      event is int (level << 6 | state), keep last capacity events
+      record 1 in sample runs, text render only when read
+    """
+
+    STATE_bits = 6
+    STATE_mask = (1 << STATE_bits) - 1
+
+    __slots__ = ('capacity', 'sample', '_events', '_pos', '_runs')
+
+    def __init__(self, capacity=4096, sample=1):
+        assert capacity > 0 and sample > 0, \
+               'trace capacity and sample need > 0'
+        self.capacity = capacity
+        self.sample = sample
+        self._events = array.array('l', [0]) * capacity
+        # event number of the run
+        self._pos = 0
+        self._runs = 0
+
+    def sample_run(self):
+        self._runs += 1
+        return (self._runs - 1) % self.sample == 0
+
+    def reset(self):
+        self._pos = 0
+
+    def append(self, level, state):
+        self._events[self._pos % self.capacity] = \
+            (level << AMLTraceBuffer.STATE_bits) | state
+        self._pos += 1
+
+    def dropped(self):
+        return max(0, self._pos - self.capacity)
+
+    def events(self):
+        """
+        [(level, state)] of last record run
+        """
+        events = self._events
+        capacity = self.capacity
+        bits = AMLTraceBuffer.STATE_bits
+        mask = AMLTraceBuffer.STATE_mask
+        return [(events[pos % capacity] >> bits, events[pos % capacity] & mask)
+                for pos in xrange(self.dropped(), self._pos)]
+
+    def state_transform_list(self):
+        state_names = AMLStateMachine.STATE_names
+        return ['%s:%s' % (level, state_names.get(state, state))
+                for level, state in self.events()]
+
+    def __str__(self):
+        return ' -> '.join('[%s]' % x for x in self.state_transform_list())
+
+
+class AMLPath(object):
+    """
+    compiled data path of location, root_location
+
+      source:
+        'level.items[3].price' -> ('level', 'items', 3, 'price')
+        "a['x.y'][0]"          -> ('a', 'x.y', 0)
+        'a\\.b[0]'             -> ('a.b', 0) backslash escape . [ ] \\
+        'name'                 -> ('name',) string without '.' '[' '\\'
+                                  is a key
+        ['a.b', 0]             -> ('a.b', 0) list item is key or index as is
+      get(data) resolve the path, parse once, no per step overhead
+
+      a string location of key with '.' or '[' (location='a.b' of the
+      key 'a.b') is a path now, escape it 'a\\.b' or use ['a.b']
+    """
+
+    TOKEN_re = re.compile(
+        r"""\.?((?:[^.\[\]'"\\]|\\.)+)|\[(-?\d+)\]|\[(['"])(.*?)\3\]""")
+    ESCAPE_re = re.compile(r'\\(.)')
+
+    __slots__ = ('source', 'steps', 'get')
+
+    def __init__(self, source):
+        self.source = source
+        self.steps = AMLPath.parse(source)
+        self.get = AMLPath._getter(self.steps)
+
+    @staticmethod
+    def compile(source):
+        if source is None or source == [] or source == ():
+            return None
+        if isinstance(source, AMLPath):
+            return source
+        return AMLPath(source)
+
+    @staticmethod
+    def parse(source):
+        if isinstance(source, (list, tuple)):
+            return tuple(source)
+        if not isinstance(source, basestring):
+            return (source,)
+        if '.' not in source and '[' not in source and '\\' not in source:
+            return (source,)
+
+        steps = []
+        pos = 0
+        while pos < len(source):
+            match = AMLPath.TOKEN_re.match(source, pos)
+            if not match or (not pos and source.startswith('.')):
+                raise AMLTemplateError("Bad location path '%s' at %s" % (
+                    source, pos))
+            key, index, _, quoted = match.groups()
+            if key is not None and pos and source[pos] != '.':
+                raise AMLTemplateError("Bad location path '%s' at %s" % (
+                    source, pos))
+            if key is not None:
+                steps.append(AMLPath.ESCAPE_re.sub(r'\1', key))
+            elif index is not None:
+                steps.append(int(index))
+            else:
+                steps.append(quoted)
+            pos = match.end()
+        return tuple(steps)
+
+    @staticmethod
+    def _getter(steps):
+        if not steps:
+            return lambda data: data
+        if len(steps) == 1:
+            return operator.itemgetter(steps[0])
+
+        def get(data):
+            for step in steps:
+                data = data[step]
+            return data
+        return get
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __str__(self):
+        return ''.join('[%r]' % step if not isinstance(step, basestring) or \
+                       '.' in step or '[' in step else '.' + step
+                       for step in self.steps).lstrip('.')
+
+    __repr__ = __str__
+
+    def __getstate__(self):
+        return self.source
+
+    def __setstate__(self, source):
+        self.__init__(source)
 
 
 class AMLStateMachine(object):
@@ -25,18 +560,25 @@ class AMLStateMachine(object):
                    -> list -> move_list -> struct_check -| -> stop
                                   ^                      |
                                   |-----------------------
-                           -> type_list -> recursive amlsm
+                           -> type_list -> push frame
                    -> dict -> move_dict -> struct_check -| -> stop
                                   ^                      |
                                   |-----------------------
-                           -> type_dict -> recursive amlsm
+                           -> type_dict -> push frame
+                   -> static dict/list -> type_static -> copy -> stop
                    -> amlmap -> [location] -> action -> for
                                                      -> if_key
+                                                     -> switch_key
+                                                     -> lookup
                                                      -> location
                                                      -> root_location
+      stop -> pop frame -> assignment -> last_state
+      nested static dict/list -> type_static -> copy -> assignment
 
     state stack:
-      1. dict and list on python function call stack
+      1. dict and list on frame stack of one state machine, a nested
+         node push a frame and start at init, the frame stop pop
+         the parent frame back
     """
 
     ### state start ###
@@ -55,6 +597,7 @@ class AMLStateMachine(object):
     STATE_struct_type_list = 14
     STATE_struct_type_dict = 15
     STATE_struct_type_amlmap = 16
+    STATE_struct_type_static = 17
     # map
     STATE_map_key = 20
     STATE_map_index = 21
@@ -63,11 +606,40 @@ class AMLStateMachine(object):
     STATE_amlmap_action_root_location = 31
     STATE_amlmap_action_if_key = 33
     STATE_amlmap_action_for_list = 32
+    STATE_amlmap_action_switch_key = 34
+    STATE_amlmap_action_lookup = 35
     # No support state
     STATE_struct_type_func = 50
 
     ### state end ###
 
+    # state name of trace
+    STATE_names = {
+        STATE_stop: 'stop',
+        STATE_init: 'init',
+        STATE_init_map: 'init_map',
+        STATE_init_list: 'init_list',
+        STATE_move_dict: 'move_tn_dict',
+        STATE_move_list: 'move_tn_list',
+        STATE_struct_check: 'struct_check',
+        STATE_struct_type_string: 'type_string',
+        STATE_struct_type_number: 'type_number',
+        STATE_struct_type_bool: 'type_bool',
+        STATE_struct_type_list: 'type_list',
+        STATE_struct_type_dict: 'type_dict',
+        STATE_struct_type_amlmap: 'type_amlmap',
+        STATE_struct_type_static: 'type_static',
+        STATE_map_key: 'map_key',
+        STATE_map_index: 'map_index',
+        STATE_amlmap_action_location: 'amlmap_action_location',
+        STATE_amlmap_action_root_location: 'amlmap_action_root_location',
+        STATE_amlmap_action_if_key: 'amlmap_action_if_key',
+        STATE_amlmap_action_for_list: 'amlmap_action_for_list',
+        STATE_amlmap_action_switch_key: 'amlmap_action_switch_key',
+        STATE_amlmap_action_lookup: 'amlmap_action_lookup',
+        STATE_struct_type_func: 'type_func',
+        }
+
     # struct type
     STRUCT_nop  = 0
     STRUCT_dict = 1
@@ -76,13 +648,76 @@ class AMLStateMachine(object):
 
     AMAP_CMD = 'amap'
 
+    __slots__ = ('_debug', '_base_level', '_level', '_off', '_struct_type',
+                 '_last_state', '_cur_state', '_template', '_cur_location',
+                 '_data', '_global_cur_data', '_cur_data', '_result', '_amap',
+                 '_action', '_dict_stack', '_dict_idx', '_dict_key',
+                 '_list_size', '_list_idx', '_for_iter', '_temp',
+                 '_frame_stack', '_frame_pool', '_state_action_map',
+                 '_trace_buffer', '_trace', '_errors', '_run_cache',
+                 '_memo_size', '_memo_key', '_share_static')
+
+    @classmethod
+    def global_initialize(cls, capacity=4096):
+        """
+        reset process wide template cache
+        """
+        cls.MAP_order_cache = AMLTemplateCache(capacity)
+        cls.STATIC_cache = AMLTemplateCache(capacity)
+
+    @classmethod
+    def cached_map_order(cls, template):
+        dict_stack = cls.MAP_order_cache.get(template)
+        if dict_stack is None:
+            dict_stack = cls.map_order(template)
+            cls.MAP_order_cache.put(template, dict_stack)
+        return dict_stack
+
+    @classmethod
+    def cached_static(cls, template):
+        """
+        AMLStaticLiteral of dict or list template, None is not static
+        """
+        static = cls.STATIC_cache.get(template)
+        if static is None:
+            static = AMLStaticLiteral.compile(template) or False
+            cls.STATIC_cache.put(template, static)
+        return static or None
+
     @classmethod
-    def global_initialize(cls):
-        cls.MAP_order_cache = dict()
+    def map_order(cls, template):
+        """
+        dict key stack of template, pop from the end:
+          'amap' first, then AMLMap by run_idx, then other node
+        """
+        # run ampmap order
+        max_idx = AMLMap.RUN_IDX + 1
+        sort_list = map(lambda x: (x[1].run_idx, x[0]) if \
+                        isinstance(x[1], AMLMap) else (max_idx, x[0]),
+                        template.items())
+        sort_list.sort(key=lambda x: x[0], reverse=True)
+        dict_stack = [item[1] for item in sort_list]
+
+        # amap_cmd to top
+        amap_cmd = cls.AMAP_CMD
+        if amap_cmd in dict_stack:
+            dict_stack.remove(amap_cmd)
+            dict_stack.append(amap_cmd)
+        return dict_stack
 
-    def __init__(self, debug, level=0):
+    def __init__(self, debug, level=0, trace_buffer=None, memo_size=0,
+                 share_static=False):
+        """
+        trace_buffer: AMLTraceBuffer, record state transform of
+                      sample run, debug record every run
+        memo_size: memo cap of sub-template result of a run, 0 is no
+                   memo, see AML
+        share_static: static sub-template result is the shared
+                      prebuilt literal, not a copy, see AML
+        """
         self._debug = debug
-        self._level = level + 1
+        self._base_level = level + 1
+        self._level = self._base_level
         self._off = True
         self._struct_type = AMLStateMachine.STRUCT_nop
         self._last_state = AMLStateMachine.STATE_init
@@ -98,28 +733,57 @@ class AMLStateMachine(object):
         self._amap = None
         self._action = None
 
-        # struct dict
+        # struct dict, dict_stack[:dict_idx] keys to move
         self._dict_stack = []
+        self._dict_idx = 0
         self._dict_key = None
 
         # struct list
         self._list_size = 0
         self._list_idx = 0
 
+        # for_list item iterator
+        self._for_iter = None
+
         self._temp = None
 
+        # parent frames, free frames
+        self._frame_stack = []
+        self._frame_pool = []
+
         # init state machine
         self._init_state_machine()
 
-        # debug
-        self._state_transform_list = []
+        # trace
+        if debug and trace_buffer is None:
+            trace_buffer = AMLTraceBuffer()
+        self._trace_buffer = trace_buffer
+        self._trace = None
+
+        # AMLErrorCollector of map miss
+        self._errors = AMLErrorCollector.default
+
+        # AMLRunCache of the run, new on first use
+        self._run_cache = None
+        self._memo_size = memo_size
+        # memo key of the frame result
+        self._memo_key = None
+        self._share_static = share_static
 
     def _clear(self):
         self._template = None
         self._cur_location = None
         self._data = None
+        self._global_cur_data = None
         self._cur_data = None
         self._result = None
+        self._amap = None
+        self._action = None
+        self._temp = None
+        self._dict_stack = []
+        self._for_iter = None
+        self._run_cache = None
+        self._memo_key = None
 
     def __debug(self, msg, *args):
         if self._debug:
@@ -128,9 +792,10 @@ class AMLStateMachine(object):
                           *args)
 
     def __state_run(self, state):
+        if self._trace is not None:
+            self._trace.append(self._level, state)
         if self._debug:
-            self._state_transform_list.append('%s:%s' % (self._level, state))
-        self.__debug('action [%s] run', state)
+            self.__debug('action [%s] run', AMLStateMachine.STATE_names[state])
 
     def _init_state_machine(self):
         self._state_action_map = {
@@ -147,6 +812,7 @@ class AMLStateMachine(object):
             AMLStateMachine.STATE_struct_type_dict: self.__action__state_type_dict,
             AMLStateMachine.STATE_struct_type_list: self.__action__state_type_list,
             AMLStateMachine.STATE_struct_type_amlmap: self.__action__state_type_amlmap,
+            AMLStateMachine.STATE_struct_type_static: self.__action__state_type_static,
             AMLStateMachine.STATE_map_key: self.__action__map_key,
             AMLStateMachine.STATE_map_index: self.__action__map_index,
             # action state
@@ -157,7 +823,11 @@ class AMLStateMachine(object):
             AMLStateMachine.STATE_amlmap_action_if_key: \
             self.__action__state_amlmap_action_if_key,
             AMLStateMachine.STATE_amlmap_action_for_list: \
-            self.__action__state_amlmap_action_for_list
+            self.__action__state_amlmap_action_for_list,
+            AMLStateMachine.STATE_amlmap_action_switch_key: \
+            self.__action__state_amlmap_action_switch_key,
+            AMLStateMachine.STATE_amlmap_action_lookup: \
+            self.__action__state_amlmap_action_lookup
             }
 
     def set_struct_type(self, struct_type):
@@ -193,39 +863,158 @@ class AMLStateMachine(object):
 
     def _assignment_or_recursive(self, template, cur_data):
         if isinstance(template, (dict, list)):
-            self._recursive_asm(template=template, cur_data=cur_data)
+            if self._recursive_asm(template=template, cur_data=cur_data):
+                self._trans_state(self._last_state)
         else:
             self._temp = template
             self._assignment()
             self._trans_state(self._last_state)
 
-    def _recursive_asm(self, state_msg=None, template=None, cur_data=None):
-        if state_msg:
-            self.__state_run(state_msg)
-        cur_location = template if template else self._cur_location
+    def _recursive_asm(self, state=None, template=None, cur_data=None):
+        """
+        return True of static or memo hit, the result is assignment
+        """
+        if state:
+            self.__state_run(state)
+        cur_location = template if template is not None \
+                       else self._cur_location
+        static = AMLStateMachine.cached_static(cur_location)
+        if static is not None:
+            self.__state_run(AMLStateMachine.STATE_struct_type_static)
+            self._temp = self._static_value(static)
+            self._assignment()
+            return True
         global_cur_data = cur_data if cur_data else self._global_cur_data
-        asm = AMLStateMachine(debug=self._debug, level=self._level)
-        self._temp = asm.starting(cur_location, self._data,
-                                  global_cur_data=global_cur_data)
-        self._state_transform_list += asm.get_state_transform_list()
+        memo_key = None
+        if self._memo_size and self._in_for_list():
+            memo_key = self._memo_lookup(cur_location, global_cur_data)
+            if memo_key is None:
+                return True
+        self._push_frame()
+        self._start_frame(cur_location, global_cur_data)
+        self._memo_key = memo_key
+        return False
+
+    def _static_value(self, static):
+        if self._share_static:
+            return static.literal
+        return static.build()
+
+    def _in_for_list(self):
+        """
+        template is in for_list item, memo container same as AMLCompiler
+        """
+        if self._for_iter is not None:
+            return True
+        for frame in self._frame_stack:
+            if frame.for_iter is not None:
+                return True
+        return False
+
+    def _memo_lookup(self, template, global_cur_data):
+        """
+        assignment the memo result and return None, or the memo key and
+        data (key, g) of the template run
+        """
+        g = global_cur_data if global_cur_data else self._data
+        # g after the leading location, same as Plan_Memo
+        if isinstance(template, dict):
+            dict_stack = AMLStateMachine.cached_map_order(template)
+            nodes = [template[key] for key in reversed(dict_stack)]
+        elif isinstance(template, list):
+            nodes = template
+        else:
+            nodes = ()
+        for node in nodes:
+            if not isinstance(node, AMLMap) or not node.action or \
+               node.action.action_name not in ('location', 'root_location'):
+                break
+            if node.path:
+                # amap location is check before the action
+                node.path.get(self._data if node.root_location else g)
+            path = node.action.parsed().path()
+            if node.action.action_name == 'root_location':
+                g = path.get(self._data)
+            else:
+                g = path.get(g)
+        key = (id(template), id(g))
+        entry = self._run_cache.memo.get(key)
+        if entry is None or entry[0] is not g:
+            return key, g
+        self._temp = entry[1]
         self._assignment()
-        self._trans_state(self._last_state)
+        return None
+
+    ### frame
+
+    def _push_frame(self):
+        frame_pool = self._frame_pool
+        frame = frame_pool.pop() if frame_pool else AMLFrame()
+        frame.level = self._level
+        frame.template = self._template
+        frame.global_cur_data = self._global_cur_data
+        frame.result = self._result
+        frame.struct_type = self._struct_type
+        frame.last_state = self._last_state
+        frame.dict_stack = self._dict_stack
+        frame.dict_idx = self._dict_idx
+        frame.dict_key = self._dict_key
+        frame.list_size = self._list_size
+        frame.list_idx = self._list_idx
+        frame.for_iter = self._for_iter
+        frame.memo_key = self._memo_key
+        self._frame_stack.append(frame)
+        self._level += 1
+
+    def _pop_frame(self):
+        frame = self._frame_stack.pop()
+        self._level = frame.level
+        self._template = frame.template
+        self._global_cur_data = frame.global_cur_data
+        self._result = frame.result
+        self._struct_type = frame.struct_type
+        self._last_state = frame.last_state
+        self._dict_stack = frame.dict_stack
+        self._dict_idx = frame.dict_idx
+        self._dict_key = frame.dict_key
+        self._list_size = frame.list_size
+        self._list_idx = frame.list_idx
+        self._for_iter = frame.for_iter
+        self._memo_key = frame.memo_key
+        # frame back to pool, no reference of template and data
+        frame.template = frame.global_cur_data = frame.result = None
+        frame.dict_stack = frame.dict_key = frame.for_iter = None
+        frame.memo_key = None
+        self._frame_pool.append(frame)
+
+    def _start_frame(self, template, global_cur_data):
+        self._template = template
+        self._global_cur_data = global_cur_data if global_cur_data \
+                                else self._data
+        self._cur_location = template
+        self._cur_data = None
+        self._result = None
+        self._dict_stack = []
+        self._dict_idx = 0
+        self._dict_key = None
+        self._list_size = 0
+        self._list_idx = 0
+        self._for_iter = None
+        self._memo_key = None
+        self._struct_type = AMLStateMachine.STRUCT_nop
+        self._last_state = AMLStateMachine.STATE_init
+        self._cur_state = AMLStateMachine.STATE_init
 
     ### data
 
-    def _data_location(self, locations, is_global=True, root_location=False):
+    def _data_location(self, path, is_global=True, root_location=False):
         if root_location:
-            cur_data = self._data
+            cur_data = path.get(self._data)
         else:
-            cur_data = self._global_cur_data
-        locations = [locations] if isinstance(locations, basestring) else locations
-
-        for loc in locations:
-            # string is key of dict
-            # number is index of list
-            cur_data = cur_data[loc]
+            cur_data = path.get(self._global_cur_data)
+        if self._debug:
             self.__debug("%s move location: %s", 'root_location' if root_location \
-                         else 'location', loc)
+                         else 'location', path)
 
         if is_global:
             self._global_cur_data = cur_data
@@ -235,60 +1024,61 @@ class AMLStateMachine(object):
     ### action
 
     def __action__state_init(self):
-        self.__state_run('init')
+        self.__state_run(AMLStateMachine.STATE_init)
         self.set_last_state(AMLStateMachine.STATE_init)
         self._trans_state(AMLStateMachine.STATE_struct_check)
 
     def __action__state_stop(self):
-        self.__state_run('stop')
-        self._off = True
+        self.__state_run(AMLStateMachine.STATE_stop)
+        if not self._frame_stack:
+            self._off = True
+            return
+
+        # frame result to parent frame
+        self._temp = self._result
+        if self._memo_key is not None:
+            memo = self._run_cache.memo
+            if len(memo) < self._memo_size:
+                key, g = self._memo_key
+                memo[key] = (g, self._result)
+        self._pop_frame()
+        self._assignment()
+        if self._for_iter is not None:
+            self._for_list_next()
+        else:
+            self._trans_state(self._last_state)
 
     def __action__state_init_map(self):
-        self.__state_run('init_map')
+        self.__state_run(AMLStateMachine.STATE_init_map)
         self._result = dict()
 
-        # use cache
-        cache_key = id(self._cur_location)
-        dict_stack = AMLStateMachine.MAP_order_cache.get(cache_key, [])
-        if dict_stack == []:
-            # run ampmap order
-            max_idx = AMLMap.RUN_IDX + 1
-            sort_list = map(lambda x: (x[1].run_idx, x[0]) if \
-                            isinstance(x[1], AMLMap) else (max_idx, x[0]),
-                            self._cur_location.items())
-            sort_list.sort(key=lambda x: x[0], reverse=True)
-            self.__debug('run_idx order: %s', sort_list)
-            dict_stack = [item[1] for item in sort_list]
-
-            # amap_cmd to top
-            amap_cmd = AMLStateMachine.AMAP_CMD
-            if amap_cmd in dict_stack:
-                self.__debug('amap_cmd top')
-                dict_stack.remove(amap_cmd)
-                dict_stack.append(amap_cmd)
-            # into cache
-            AMLStateMachine.MAP_order_cache[cache_key] = dict_stack
-
-        self._dict_stack = copy.copy(dict_stack)
+        # use cache, the cached stack is not change
+        dict_stack = AMLStateMachine.cached_map_order(self._cur_location)
+        self.__debug('run_idx order: %s', dict_stack)
+
+        self._dict_stack = dict_stack
+        self._dict_idx = len(dict_stack)
         self._trans_state(AMLStateMachine.STATE_move_dict)
 
     def __action__state_init_list(self):
-        self.__state_run('init_list')
+        self.__state_run(AMLStateMachine.STATE_init_list)
         self._result = list()
         self._list_size = len(self._cur_location)
         self._list_idx = 0
         self._trans_state(AMLStateMachine.STATE_move_list)
 
     def __action__state_move_dict(self):
-        self.__state_run('move_tn_dict')
-        self.__debug('dict keys: %s', self._dict_stack)
+        self.__state_run(AMLStateMachine.STATE_move_dict)
+        if self._debug:
+            self.__debug('dict keys: %s', self._dict_stack[:self._dict_idx])
 
         # stop
-        if len(self._dict_stack) == 0:
+        if self._dict_idx == 0:
             self._trans_state(AMLStateMachine.STATE_stop)
             return
 
-        key = self._dict_stack.pop()
+        self._dict_idx -= 1
+        key = self._dict_stack[self._dict_idx]
         self._cur_location = self._template[key]
         self._dict_key = key
         self._trans_state(AMLStateMachine.STATE_struct_check,
@@ -296,7 +1086,7 @@ class AMLStateMachine(object):
                           struct_type=AMLStateMachine.STRUCT_dict)
 
     def __action__state_move_list(self):
-        self.__state_run('move_tn_list')
+        self.__state_run(AMLStateMachine.STATE_move_list)
         self._list_idx += 1
         self.__debug('list size:%s idx:%s', self._list_size, self._list_idx)
 
@@ -312,7 +1102,7 @@ class AMLStateMachine(object):
                           struct_type=AMLStateMachine.STRUCT_list)
 
     def __action__state_struct_check(self):
-        self.__state_run('struct_check')
+        self.__state_run(AMLStateMachine.STATE_struct_check)
         node = self._cur_location
         if isinstance(node, basestring):
             self.set_cur_state(AMLStateMachine.STATE_struct_type_string)
@@ -320,6 +1110,11 @@ class AMLStateMachine(object):
             self.set_cur_state(AMLStateMachine.STATE_struct_type_bool)
         elif isinstance(node, (int, long, float)):
             self.set_cur_state(AMLStateMachine.STATE_struct_type_number)
+        elif isinstance(node, (dict, list)) and not self._frame_stack and \
+             self._last_state is AMLStateMachine.STATE_init and \
+             AMLStateMachine.cached_static(node) is not None:
+            # static run template, nested one is by _recursive_asm
+            self.set_cur_state(AMLStateMachine.STATE_struct_type_static)
         elif isinstance(node, dict):
             if self._last_state is AMLStateMachine.STATE_init:
                 self.set_cur_state(AMLStateMachine.STATE_init_map)
@@ -341,33 +1136,39 @@ class AMLStateMachine(object):
         self._trans_state(self._last_state)
 
     def __action__state_type_string(self):
-        self.__state_run('type_string')
+        self.__state_run(AMLStateMachine.STATE_struct_type_string)
         self.__action__state_type_basic()
 
     def __action__state_type_number(self):
-        self.__state_run('type_number')
+        self.__state_run(AMLStateMachine.STATE_struct_type_number)
         self.__action__state_type_basic()
 
     def __action__state_type_bool(self):
-        self.__state_run('type_bool')
+        self.__state_run(AMLStateMachine.STATE_struct_type_bool)
         self.__action__state_type_basic()
 
+    def __action__state_type_static(self):
+        self.__state_run(AMLStateMachine.STATE_struct_type_static)
+        static = AMLStateMachine.cached_static(self._cur_location)
+        self._result = self._static_value(static)
+        self._trans_state(AMLStateMachine.STATE_stop)
+
     def __action__state_type_dict(self):
-        self._recursive_asm(state_msg='type_dict')
+        if self._recursive_asm(state=AMLStateMachine.STATE_struct_type_dict):
+            self._trans_state(self._last_state)
 
     def __action__state_type_list(self):
-        self._recursive_asm(state_msg='type_list')
+        if self._recursive_asm(state=AMLStateMachine.STATE_struct_type_list):
+            self._trans_state(self._last_state)
 
     def __action__map_key(self):
         data_key = self._amap.key
         self._temp = None
 
-        if not isinstance(self._cur_data, dict):
-            logging.error("map_key '%s' data no dict data:%s",
-                          self._dict_key, self._cur_data)
-        elif data_key not in self._cur_data:
-            logging.error("map_key '%s' from '%s' failed data:%s",
-                          self._dict_key, data_key, self._cur_data)
+        if not isinstance(self._cur_data, dict) or \
+           data_key not in self._cur_data:
+            self._errors.miss(AMLErrorCollector.KIND_map_key,
+                              self._template_path(), data_key, self._cur_data)
         else:
             temp = self._cur_data[data_key]
             self._temp = self._amap.type(temp) if self._amap.type else temp
@@ -379,12 +1180,10 @@ class AMLStateMachine(object):
         index = self._amap.index
         self._temp = None
 
-        if not isinstance(self._cur_data, list):
-            logging.error("map_index '%s' data no list data:%s",
-                          self._list_idx, self._cur_data)
-        elif index >= len(self._cur_data):
-            logging.error("map_index '%s' from '%s' failed data:%s",
-                          self._list_idx, index, self._cur_data)
+        if not isinstance(self._cur_data, list) or \
+           index >= len(self._cur_data):
+            self._errors.miss(AMLErrorCollector.KIND_map_index,
+                              self._template_path(), index, self._cur_data)
         else:
             temp = self._cur_data[index]
             self._temp = self._amap.type(temp) if self._amap.type else temp
@@ -393,15 +1192,13 @@ class AMLStateMachine(object):
         self._trans_state(self._last_state)
 
     def __action__state_type_amlmap(self):
-        self.__state_run('type_amlmap')
+        self.__state_run(AMLStateMachine.STATE_struct_type_amlmap)
         amap = self._cur_location
         # reset cur_data, clear a amap local cur_data setting
         self._cur_data = self._global_cur_data
-        if amap.location:
-            self._data_location(amap.location, is_global=False)
-        if amap.root_location:
-            self._data_location(amap.root_location, is_global=False,
-                                root_location=True)
+        if amap.path:
+            self._data_location(amap.path, is_global=False,
+                                root_location=bool(amap.root_location))
 
         self._amap = amap
         self._action = amap.action
@@ -416,71 +1213,148 @@ class AMLStateMachine(object):
             self._trans_state(AMLStateMachine.STATE_stop)
 
     def __action__state_amlmap_action_location(self):
-        self.__state_run('amlmap_action_location')
-        action = self._action
-        locations = action.argument_list[0]
-        assert locations, "action location needs has argument 'locations'!!!"
-        self._data_location(locations)
+        self.__state_run(AMLStateMachine.STATE_amlmap_action_location)
+        self._data_location(self._action.parsed().path())
         self._trans_state(self._last_state)
 
     def __action__state_amlmap_action_root_location(self):
-        self.__state_run('amlmap_action_root_location')
-        action = self._action
-        locations = action.argument_list[0]
-        assert locations, "action root_location needs has argument 'locations'!!!"
-        self._data_location(locations, root_location=True)
+        self.__state_run(AMLStateMachine.STATE_amlmap_action_root_location)
+        self._data_location(self._action.parsed().path(), root_location=True)
         self._trans_state(self._last_state)
 
-    def _create_action(self, action_class):
-        action_obj = action_class(self._action, self._cur_location, self._cur_data)
-        assert action_obj.parse(), action_obj.error_message()        
-        assert action_obj.validity_check(), action_obj.error_message()
-        return action_obj
-
     def __action__state_amlmap_action_if_key(self):
-        self.__state_run('amlmap_action_if_key')
-        action_ifkey = self._create_action(Action_Ifkey)
-        template = action_ifkey.exec_action()
+        self.__state_run(AMLStateMachine.STATE_amlmap_action_if_key)
+        template = self._action.parsed().exec_action(self._cur_data)
+        if template is not None:
+            self._assignment_or_recursive(template, self._cur_data)
+        else:
+            self._trans_state(self._last_state)
+
+    def __action__state_amlmap_action_switch_key(self):
+        self.__state_run(AMLStateMachine.STATE_amlmap_action_switch_key)
+        template = self._action.parsed().exec_action(self._cur_data)
         if template is not None:
             self._assignment_or_recursive(template, self._cur_data)
         else:
             self._trans_state(self._last_state)
 
+    def __action__state_amlmap_action_lookup(self):
+        self.__state_run(AMLStateMachine.STATE_amlmap_action_lookup)
+        if self._run_cache is None:
+            self._run_cache = AMLRunCache()
+        action = self._action.parsed()
+        row = action.find(self._data, self._cur_data, self._run_cache)
+        template = action.template()
+        if row is Action_Lookup.SKIP:
+            self._trans_state(self._last_state)
+        elif row is None or template is None:
+            self._temp = row
+            self._assignment()
+            self._trans_state(self._last_state)
+        else:
+            self._assignment_or_recursive(template, row)
+
     def __action__state_amlmap_action_for_list(self):
-        self.__state_run('amlmap_action_for_list')
-        action_forlist = self._create_action(Action_ForList)
-        def for_iter_callback(template, data):
-            self._recursive_asm(template=template, cur_data=data)
-            return Action_ForList.ITER_state_continue
+        self.__state_run(AMLStateMachine.STATE_amlmap_action_for_list)
+        self._for_iter = self._action.parsed().iter_items(self._cur_data)
+        self._for_list_next()
 
-        action_forlist.exec_action(for_iter_callback)
-        self._trans_state(self._last_state)
+    def _for_list_next(self):
+        while True:
+            item = next(self._for_iter, None)
+            if item is None:
+                self._for_iter = None
+                self._trans_state(self._last_state)
+                return
+            template, data = item
+            # memo hit is assignment, next item
+            if not self._recursive_asm(template=template, cur_data=data):
+                return
+
+    def _template_path(self):
+        """
+        template path of current node, same as plan node path
+        """
+        parts = []
+        frames = [(frame.struct_type, frame.dict_key, frame.list_idx,
+                   frame.for_iter) for frame in self._frame_stack]
+        frames.append((self._struct_type, self._dict_key, self._list_idx,
+                       None))
+        for struct_type, dict_key, list_idx, for_iter in frames:
+            if struct_type == AMLStateMachine.STRUCT_dict:
+                parts.append('.%s' % dict_key)
+            elif struct_type == AMLStateMachine.STRUCT_list:
+                parts.append('[%s]' % (list_idx - 1))
+            if for_iter is not None:
+                parts.append('[*]')
+        path = ''.join(parts)
+        return path[1:] if path.startswith('.') else path
 
     # user interface
 
+    def get_trace(self):
+        """
+        AMLTraceBuffer of the machine, None is no trace
+        """
+        return self._trace_buffer
+
     def get_state_transform_list(self):
-        return self._state_transform_list
+        if self._trace_buffer is None:
+            return []
+        return self._trace_buffer.state_transform_list()
 
-    def starting(self, template, data, global_cur_data=None):
-        # init data
-        self._template = template
+    def is_running(self):
+        return not self._off
+
+    def starting(self, template, data, global_cur_data=None, errors=None):
+        """
+        errors: AMLErrorCollector of map miss, default is the process
+                AMLErrorCollector.default
+        """
+        # init data, machine can starting again
         self._data = data
-        self._global_cur_data = global_cur_data if global_cur_data else data
-        self._cur_location = self._template
+        self._errors = errors if errors is not None \
+                       else AMLErrorCollector.default
+        if self._memo_size:
+            self._run_cache = AMLRunCache(self._memo_size)
+        self._level = self._base_level
+        self._frame_stack = []
+        trace_buffer = self._trace_buffer
+        if trace_buffer is not None and \
+           (self._debug or trace_buffer.sample_run()):
+            trace_buffer.reset()
+            self._trace = trace_buffer
+        else:
+            self._trace = None
+        self._start_frame(template, global_cur_data)
         self._off = False
 
         # state machine starting!!!!
         self.__debug('starting!!')
-        while not self._off:
-            self.state_action()()
+        try:
+            while not self._off:
+                self.state_action()()
+        except Exception:
+            # machine can starting again
+            self._off = True
+            self._clear()
+            raise
         self.__debug('stop!!')
 
         result = self._result
         self._clear()
         return result
 
+AMLStateMachine.global_initialize()
+
+
 class AMLMap(object):
     RUN_IDX = 0
+    _run_idx_lock = threading.Lock()
+
+    __slots__ = ('run_idx', 'key', 'index', 'action', 'type', 'location',
+                 'root_location', 'path')
+
     def __init__(self, key=None, index=None, action=None,
                  type=None, location=None, root_location=None):
         """
@@ -489,17 +1363,23 @@ class AMLMap(object):
         action: xx
         type: xx
         location: [string, int], string is dict key, int is list index
+                  or path string 'level.items[3].price', key with '.'
+                  '[' of path string need escape 'a\\.b', see AMLPath
         """
-        AMLMap.RUN_IDX += 1
-        self.run_idx = AMLMap.RUN_IDX
+        with AMLMap._run_idx_lock:
+            AMLMap.RUN_IDX += 1
+            self.run_idx = AMLMap.RUN_IDX
         self.key = key
         self.index = index
         self.action = action
         self.type = type
         self.location = location
         self.root_location = root_location
-        assert not (location and root_location), \
-               'location and root_location two choose one'
+        if location and root_location:
+            raise AMLTemplateError("location and root_location two choose "
+                                   "one, location:%r root_location:%r" % (
+                                   location, root_location))
+        self.path = AMLPath.compile(location or root_location or None)
 
     def __str__(self):
         argument_tuple = (id(self), self.run_idx, self.key, \
@@ -511,18 +1391,56 @@ class AMLMap(object):
 
     __repr__ = __str__
 
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in AMLMap.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.path = AMLPath.compile(self.location or self.root_location or
+                                    None)
+
 class AMLAction(object):
     action_map = {
         'root_location': AMLStateMachine.STATE_amlmap_action_root_location,
         'location': AMLStateMachine.STATE_amlmap_action_location,
         'if_key': AMLStateMachine.STATE_amlmap_action_if_key,
-        'for_list': AMLStateMachine.STATE_amlmap_action_for_list
+        'for_list': AMLStateMachine.STATE_amlmap_action_for_list,
+        'switch_key': AMLStateMachine.STATE_amlmap_action_switch_key,
+        'lookup': AMLStateMachine.STATE_amlmap_action_lookup
         }
+    __slots__ = ('action_name', 'argument_list', 'argument_dict', 'path',
+                 '_parsed')
+
     def __init__(self, action, *args, **kwargs):
-        assert action in AMLAction.action_map, "Unknow action: '%s'" % action
+        if action not in AMLAction.action_map:
+            raise AMLTemplateError("Unknow action: '%s'" % action)
         self.action_name = action
         self.argument_list = args
         self.argument_dict = kwargs
+        self.path = self._compile_path()
+        self._parsed = None
+
+    def parsed(self):
+        """
+        action object of the argument, parse and static check once,
+        shared by every run, raise AMLTemplateError
+        """
+        parsed = self._parsed
+        if parsed is None:
+            action_class = AMLAction.action_classes[self.action_name]
+            parsed = action_class(self)
+            if not parsed.parse() or not parsed.validity_check():
+                raise AMLTemplateError('%s\n%s' % (self,
+                                                   parsed.error_message()))
+            self._parsed = parsed
+        return parsed
+
+    def _compile_path(self):
+        if self.action_name not in ('location', 'root_location') or \
+           not self.argument_list or not self.argument_list[0]:
+            return None
+        return AMLPath.compile(self.argument_list[0])
 
     def action_state(self):
         return AMLAction.action_map.get(self.action_name, None)
@@ -533,8 +1451,24 @@ class AMLAction(object):
 
     __repr__ = __str__
 
+    def __getstate__(self):
+        return (self.action_name, self.argument_list, self.argument_dict)
+
+    def __setstate__(self, state):
+        self.action_name, self.argument_list, self.argument_dict = state
+        self.path = self._compile_path()
+        self._parsed = None
+
 
 class ActionBase(object):
+    """
+    action argument parse and check once by AMLAction.parsed(), the
+    object is shared by every run, data is argument of exec
+
+      _parse: parse argument, parse_failure() on error
+      _checkpoint__*: static check of argument, check_failure() on error
+      check_data(data): data check of exec, raise AMLDataError
+    """
 
     COMPARE_op_actons = {
         '==' : lambda v1, v2: v1 == v2,
@@ -546,12 +1480,13 @@ class ActionBase(object):
         }
 
     CHECKPOINT_list = {}
+
+    __slots__ = ('_action', '_error_messages', '_validity_result',
+                 '_validity_checkpoint_list', '_parse_state')
     
-    def __init__(self, action, template, data):
+    def __init__(self, action):
         assert hasattr(self, 'action_name'), 'Action class need action_name attr!!!'
         self._action = action
-        self._template = template
-        self._data = data
         self._error_messages = []
         self._validity_result = True
         self._load_checkpoint()
@@ -562,19 +1497,14 @@ class ActionBase(object):
             return
 
         checkpoint_list = [] 
-        ActionBase.CHECKPOINT_list[self.action_name] = checkpoint_list
         logging.debug('%s load checkpoint', self.action_name)
         symbol_list = dir(self)
         for symbol in symbol_list:
             if symbol.startswith('_checkpoint__'):
                 logging.debug('-- load %s', symbol)
                 checkpoint_list.append(symbol)
-
-    def data(self):
-        return self._data
-
-    def template(self):
-        return self._template
+        # other thread see the whole list
+        ActionBase.CHECKPOINT_list[self.action_name] = checkpoint_list
 
     def add_error_message(self, error_message):
         self._error_messages.append(error_message)
@@ -583,9 +1513,8 @@ class ActionBase(object):
         self._validity_checkpoint_list.append(checkpoint)
 
     def error_message(self):
-        for idx, msg in enumerate(self._error_messages):
-            self._error_messages[idx] = '%s. %s' % (idx+1, msg)
-        return '\n'.join(self._error_messages)
+        return '\n'.join('%s. %s' % (idx+1, msg)
+                         for idx, msg in enumerate(self._error_messages))
 
     def parse_failure(self):
         self._parse_state = False
@@ -612,11 +1541,31 @@ class ActionBase(object):
     def _validity_check(self):
         pass
 
+    def check_data(self, data):
+        pass
+
+class Action_Location(ActionBase):
+    action_name = 'action_location'
+
+    __slots__ = ('_path',)
+
+    def _parse(self):
+        self._path = self._action.path
+
+    def _checkpoint__1_locations(self):
+        if not self._path:
+            self.add_error_message("action %s needs has argument 'locations'" %
+                                   self._action.action_name)
+            self.check_failure()
+
+    def path(self):
+        return self._path
+
 class Action_Ifkey(ActionBase):
     action_name = 'action_ifkey'
 
-    def __init__(self, action, template, data):
-        super(Action_Ifkey, self).__init__(action, template, data)
+    __slots__ = ('_key', '_op', '_value', '_compare', '_block_template',
+                 '_else_template')
 
     def _parse(self):
         action = self._action
@@ -645,31 +1594,223 @@ class Action_Ifkey(ActionBase):
                                    'two choose one')
             self.check_failure()
 
-    def _checkpoint__2_type(self):
-        if self._key not in self.data():
-            self.add_error_message('key: %s not in %s' % (self._key, self._data))
-            self.check_failure()
-
-        if self._op not in Action_Ifkey.COMPARE_op_actons.keys():
+    def _checkpoint__2_op(self):
+        if self._op not in Action_Ifkey.COMPARE_op_actons:
             self.add_error_message("if_key op '%s' not support, support %s" % \
                                    (self._op, Action_Ifkey.COMPARE_op_actons.keys()))
             self.check_failure()
+            return
+        self._compare = Action_Ifkey.COMPARE_op_actons[self._op]
 
-    def exec_action(self):
-        data_value = self.data()[self._key]
-        if Action_Ifkey.COMPARE_op_actons[self._op](data_value, self._value):
+    def check_data(self, data):
+        if self._key not in data:
+            raise AMLDataError("if_key key: %r not in %s data" %
+                               (self._key, type(data).__name__))
+
+    def exec_action(self, data):
+        self.check_data(data)
+        if self._compare(data[self._key], self._value):
             return self._block_template
         else:
             return self._else_template
 
+class Action_SwitchKey(ActionBase):
+    """
+    switch_key: data[key] value -> template of cases, default when no
+    case, cases dict is the hash table of the switch
+    """
+    action_name = 'action_switchkey'
+
+    __slots__ = ('_key', '_cases', '_default')
+
+    def _parse(self):
+        action = self._action
+        if len(action.argument_list) != 1:
+            self.add_error_message('parse faield, argument error, ' \
+                                   'need has key. argument:%s' % \
+                                   str(action.argument_list))
+            self.parse_failure()
+            return
+        self._key = action.argument_list[0]
+        self._cases = action.argument_dict.get('cases', None)
+        self._default = action.argument_dict.get('default', None)
+
+    def _checkpoint__1_exists(self):
+        if not self._key:
+            self.add_error_message("switch_key key not exists, key:'%s'" %
+                                   self._key)
+            self.check_failure()
+
+        if not isinstance(self._cases, dict):
+            self.add_error_message("switch_key need has argument 'cases' " \
+                                   "dict, cases:%s" % str(self._cases))
+            self.check_failure()
+
+    def check_data(self, data):
+        if self._key not in data:
+            raise AMLDataError("switch_key key: %r not in %s data" %
+                               (self._key, type(data).__name__))
+
+    def cases(self):
+        return self._cases
+
+    def default(self):
+        return self._default
+
+    @staticmethod
+    def select(cases, value, default):
+        """
+        cases[value], default of no case and unhashable value
+        """
+        try:
+            return cases.get(value, default)
+        except TypeError:
+            return default
+
+    def exec_action(self, data):
+        self.check_data(data)
+        return Action_SwitchKey.select(self._cases, data[self._key],
+                                       self._default)
+
+class Action_Lookup(ActionBase):
+    """
+    lookup: join row of root table list by key field
+
+      Action('lookup', table, key_field, local_key, template=None,
+             missing='none', duplicate='first')
+      table: root data path of the list of row dict
+      value is the row of row[key_field] == data[local_key], or run
+      template with g of the row
+      missing: no row, no local_key, unhashable value
+        'none' -> None, 'skip' -> no assignment, 'error' -> AMLDataError
+      duplicate: row of same key, 'first', 'last' row or 'error'
+      index {key: row} of the table is build once of a run (AMLRunCache),
+      row not dict or without key_field is not in index
+    """
+    action_name = 'action_lookup'
+
+    MISSING_policys = ('none', 'skip', 'error')
+    DUPLICATE_policys = ('first', 'last', 'error')
+
+    # missing row of policy 'skip'
+    SKIP = object()
+
+    __slots__ = ('_table', '_key_field', '_local_key', '_template',
+                 '_missing', '_duplicate')
+
+    def _parse(self):
+        action = self._action
+        if len(action.argument_list) != 3:
+            self.add_error_message('parse faield, argument error, ' \
+                                   'need has table, key_field, local_key. ' \
+                                   'argument:%s' % str(action.argument_list))
+            self.parse_failure()
+            return
+        table, self._key_field, self._local_key = action.argument_list
+        try:
+            self._table = AMLPath.compile(table)
+        except AMLTemplateError as e:
+            self.add_error_message(str(e))
+            self.parse_failure()
+            return
+        self._template = action.argument_dict.get('template', None)
+        self._missing = action.argument_dict.get('missing', 'none')
+        self._duplicate = action.argument_dict.get('duplicate', 'first')
+
+    def _checkpoint__1_exists(self):
+        if not (self._table and self._key_field and self._local_key):
+            self.add_error_message("table or key_field or local_key not " \
+                                   "exists, table:'%s', key_field:'%s', " \
+                                   "local_key:'%s'" % (self._table,
+                                   self._key_field, self._local_key))
+            self.check_failure()
+
+    def _checkpoint__2_policy(self):
+        if self._missing not in Action_Lookup.MISSING_policys:
+            self.add_error_message("lookup missing '%s' not support, " \
+                                   "support %s" % (self._missing,
+                                   Action_Lookup.MISSING_policys))
+            self.check_failure()
+        if self._duplicate not in Action_Lookup.DUPLICATE_policys:
+            self.add_error_message("lookup duplicate '%s' not support, " \
+                                   "support %s" % (self._duplicate,
+                                   Action_Lookup.DUPLICATE_policys))
+            self.check_failure()
+
+    def template(self):
+        return self._template
+
+    def table_steps(self):
+        return self._table.steps
+
+    def index(self, root, cache):
+        """
+        {key: row} of the table, cache is AMLRunCache or None
+        """
+        table = self._table.get(root)
+        if cache is None:
+            return self._build(table)
+        cache_key = (id(table), self._key_field, self._duplicate)
+        index = cache.indexes.get(cache_key)
+        if index is None:
+            index = cache.indexes[cache_key] = self._build(table)
+        return index
+
+    def _build(self, table):
+        if not isinstance(table, list):
+            raise AMLDataError("lookup table '%s' need has list data, "
+                               "data is %s" % (self._table,
+                                               type(table).__name__))
+        key_field = self._key_field
+        duplicate = self._duplicate
+        index = {}
+        for row in table:
+            if not isinstance(row, dict) or key_field not in row:
+                continue
+            key = row[key_field]
+            try:
+                exists = key in index
+            except TypeError:
+                # unhashable key is no row
+                continue
+            if exists:
+                if duplicate == 'first':
+                    continue
+                if duplicate == 'error':
+                    raise AMLDataError("lookup table '%s' duplicate %s: %r" %
+                                       (self._table, key_field, key))
+            index[key] = row
+        return index
+
+    def find(self, root, data, cache):
+        """
+        row of data[local_key], None or Action_Lookup.SKIP of missing
+        """
+        index = self.index(root, cache)
+        row = None
+        if isinstance(data, dict) and self._local_key in data:
+            try:
+                row = index.get(data[self._local_key])
+            except TypeError:
+                pass
+        if row is not None:
+            return row
+        if self._missing == 'skip':
+            return Action_Lookup.SKIP
+        if self._missing == 'error':
+            raise AMLDataError("lookup table '%s' no %s of %s: %r" % (
+                self._table, self._key_field, self._local_key,
+                data.get(self._local_key) if isinstance(data, dict)
+                else None))
+        return None
+
 class Action_ForList(ActionBase):
     action_name = 'action_forlist'
 
     ITER_state_continue = 0
     ITER_state_break = 1
 
-    def __init__(self, action, template, data):
-        super(Action_ForList, self).__init__(action, template, data)
+    __slots__ = ('_template',)
 
     def _parse(self):
         action = self._action
@@ -685,34 +1826,2971 @@ class Action_ForList(ActionBase):
             self.add_error_message("'for_list' need has argument 'template'")
             self.check_failure()
 
-    def _checkpoint__2_data_is_list(self):
-        if not isinstance(self.data(), list):
-            self.add_error_message("'for_list' data need has list data:%s" % \
-                                   str(self.data()))
-            self.check_failure()
+    def check_data(self, data):
+        if not isinstance(data, list):
+            raise AMLDataError("'for_list' data need has list data, "
+                               "data is %s" % type(data).__name__)
+
+    def template(self):
+        return self._template
+
+    def iter_items(self, data):
+        """
+        iterator of (template, data_item)
+        """
+        self.check_data(data)
+        template = self._template
+        return ((template, data_item) for data_item in data)
 
-    def exec_action(self, iter_callback):
-        for data_item in self.data():
-            iter_state = iter_callback(self.template(), data_item)
+    def exec_action(self, data, iter_callback):
+        for template, data_item in self.iter_items(data):
+            iter_state = iter_callback(template, data_item)
             if iter_state is Action_ForList.ITER_state_break:
                 break
 
-class AML(object):
-    def __init__(self, debug=False, level=0):
-        self._debug = debug
-        self._amlsm = AMLStateMachine(debug, level)
-        AMLStateMachine.global_initialize()
+AMLAction.action_classes = {
+    'root_location': Action_Location,
+    'location': Action_Location,
+    'if_key': Action_Ifkey,
+    'for_list': Action_ForList,
+    'switch_key': Action_SwitchKey,
+    'lookup': Action_Lookup
+    }
 
-    def _assembly_and_map(self, template, data):
-        return self._amlsm.starting(template, data)
+class PlanBase(object):
+    """
+    compiled template node, template is inspected once at compile time,
+    node run only touches data
 
-    def run(self, template, data):
-        if isinstance(template, basestring):
-            return template
-        result = self._assembly_and_map(template, data)
-        if self._debug:
-            state_transform_list = self._amlsm.get_state_transform_list()
-            logging.debug('state transform: %s',
-                          ' -> '.join(map(lambda x: "[%s]" % x,
-                                          state_transform_list)))
+    run by parent container on kind:
+      literal  -> assignment node.literal
+      value    -> assignment node.value(root, g), skip PlanBase.SKIP
+      location -> g = node.locate(root, g)
+      multi    -> assignment every item of node.values(root, g)
+      stop     -> node.stop(root, g), last node of container
+    root is data, g is container global cur_data
+    """
+
+    KIND_literal = 0
+    KIND_value = 1
+    KIND_location = 2
+    KIND_multi = 3
+    KIND_stop = 4
+
+    # value no assignment
+    SKIP = object()
+
+    kind = KIND_value
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return '<%s at 0x%x path:%s>' % (self.__class__.__name__, id(self),
+                                         self.path)
+
+    __repr__ = __str__
+
+
+class Plan_Literal(PlanBase):
+    kind = PlanBase.KIND_literal
+
+    def __init__(self, path, literal):
+        super(Plan_Literal, self).__init__(path)
+        self.literal = literal
+
+    def value(self, root, g):
+        return self.literal
+
+
+class Plan_Static(PlanBase):
+    """
+    static dict or list, value is a new copy of AMLStaticLiteral
+    """
+
+    def __init__(self, path, static):
+        super(Plan_Static, self).__init__(path)
+        self.static = static
+
+    def value(self, root, g):
+        return self.static.build()
+
+
+class Plan_Dict(PlanBase):
+
+    def __init__(self, path, children):
+        """
+        children: [(key, node)] in run order
+        """
+        super(Plan_Dict, self).__init__(path)
+        self.children = children
+        self.key_index = dict((key, idx)
+                              for idx, (key, _) in enumerate(children))
+
+    def value(self, root, g):
+        if not g:
+            g = root
+        result = {}
+        for key, node in self.children:
+            kind = node.kind
+            if kind is PlanBase.KIND_literal:
+                result[key] = node.literal
+            elif kind is PlanBase.KIND_value:
+                temp = node.value(root, g)
+                if temp is not PlanBase.SKIP:
+                    result[key] = temp
+            elif kind is PlanBase.KIND_location:
+                g = node.locate(root, g)
+            elif kind is PlanBase.KIND_multi:
+                for temp in node.values(root, g):
+                    result[key] = temp
+            else:
+                node.stop(root, g)
+        return result
+
+
+class Plan_List(PlanBase):
+
+    def __init__(self, path, children):
+        """
+        children: [node] in template order
+        """
+        super(Plan_List, self).__init__(path)
+        self.children = children
+
+    def value(self, root, g):
+        if not g:
+            g = root
+        result = []
+        for node in self.children:
+            kind = node.kind
+            if kind is PlanBase.KIND_literal:
+                result.append(node.literal)
+            elif kind is PlanBase.KIND_value:
+                temp = node.value(root, g)
+                if temp is not PlanBase.SKIP:
+                    result.append(temp)
+            elif kind is PlanBase.KIND_location:
+                g = node.locate(root, g)
+            elif kind is PlanBase.KIND_multi:
+                result.extend(node.values(root, g))
+            else:
+                node.stop(root, g)
+        return result
+
+
+class Plan_Memo(object):
+    """
+    mixin of container evaluated many times of a run (in for_list
+    item), result is memo in AMLRunCache by (node, id(data)), data is
+    g after the leading location child, so a root_location block is
+    one result of the run
+
+      the memo result is shared by every place of the run result, map
+      miss of a memo hit is not report again
+    """
+
+    def memo_g(self, root, g):
+        g = g if g else root
+        for node in self.memo_locations:
+            g = node.locate(root, g)
+        return g
+
+    @staticmethod
+    def call(node, function, root, g):
+        """
+        memo function(root, g) of node
+        """
+        cache = AMLRunCache.current()
+        if cache is None or not cache.memo_size:
+            return function(root, g)
+        data = node.memo_g(root, g)
+        key = (node, id(data))
+        memo = cache.memo
+        entry = memo.get(key)
+        if entry is not None and entry[0] is data:
+            return entry[1]
+        result = function(root, g)
+        if len(memo) < cache.memo_size:
+            memo[key] = (data, result)
         return result
+
+    def value(self, root, g):
+        return Plan_Memo.call(self, super(Plan_Memo, self).value, root, g)
+
+
+class Plan_MemoDict(Plan_Memo, Plan_Dict):
+
+    def __init__(self, path, children):
+        super(Plan_MemoDict, self).__init__(path, children)
+        self.memo_locations = list(itertools.takewhile(
+            lambda node: node.kind is PlanBase.KIND_location,
+            (node for _, node in children)))
+
+
+class Plan_MemoList(Plan_Memo, Plan_List):
+
+    def __init__(self, path, children):
+        super(Plan_MemoList, self).__init__(path, children)
+        self.memo_locations = list(itertools.takewhile(
+            lambda node: node.kind is PlanBase.KIND_location, children))
+
+
+class Plan_AMapBase(PlanBase):
+    """
+    amap node, cur_data is g moved by amap location or root_location
+    """
+
+    def __init__(self, path, amap):
+        super(Plan_AMapBase, self).__init__(path)
+        self.amap = amap
+        path = amap.path
+        self._locations = path.steps if path else ()
+        self._get = path.get if path else None
+        self._is_root = bool(amap.root_location)
+
+    def cur_data(self, root, g):
+        if self._get is None:
+            return g
+        return self._get(root if self._is_root else g)
+
+
+class Plan_MapKey(Plan_AMapBase):
+
+    def __init__(self, path, amap):
+        super(Plan_MapKey, self).__init__(path, amap)
+        self._key = amap.key
+        self._type = amap.type
+
+    def value(self, root, g):
+        return self.map(self.cur_data(root, g))
+
+    def map(self, cur_data):
+        if not isinstance(cur_data, dict) or self._key not in cur_data:
+            AMLErrorCollector.current().miss(AMLErrorCollector.KIND_map_key,
+                                             self.path, self._key, cur_data)
+            return None
+        temp = cur_data[self._key]
+        return self._type(temp) if self._type else temp
+
+
+class Plan_MapIndex(Plan_AMapBase):
+
+    def __init__(self, path, amap):
+        super(Plan_MapIndex, self).__init__(path, amap)
+        self._index = amap.index
+        self._type = amap.type
+
+    def value(self, root, g):
+        return self.map(self.cur_data(root, g))
+
+    def map(self, cur_data):
+        if not isinstance(cur_data, list) or self._index >= len(cur_data):
+            AMLErrorCollector.current().miss(AMLErrorCollector.KIND_map_index,
+                                             self.path, self._index, cur_data)
+            return None
+        temp = cur_data[self._index]
+        return self._type(temp) if self._type else temp
+
+
+class Plan_Location(Plan_AMapBase):
+    kind = PlanBase.KIND_location
+
+    def __init__(self, path, amap, root_location=False):
+        super(Plan_Location, self).__init__(path, amap)
+        path = amap.action.parsed().path()
+        self._action_locations = path.steps
+        self._action_get = path.get
+        self._action_root = root_location
+
+    def locate(self, root, g):
+        if self._get is not None:
+            self.cur_data(root, g)
+        return self._action_get(root if self._action_root else g)
+
+
+class Plan_IfKey(Plan_AMapBase):
+
+    def __init__(self, path, amap, block, else_):
+        super(Plan_IfKey, self).__init__(path, amap)
+        argument_list = amap.action.argument_list
+        self._action = amap.action.parsed()
+        self._key = argument_list[0]
+        self._op = argument_list[1]
+        self._value = argument_list[2]
+        self._compare = ActionBase.COMPARE_op_actons[self._op]
+        self._block = block
+        self._else = else_
+
+    def branch(self, cur_data):
+        if self._key not in cur_data:
+            self._action.check_data(cur_data)
+        if self._compare(cur_data[self._key], self._value):
+            return self._block
+        return self._else
+
+    def branches(self):
+        """
+        all the branch node, no None
+        """
+        return [branch for branch in (self._block, self._else)
+                if branch is not None]
+
+    def value(self, root, g):
+        cur_data = self.cur_data(root, g)
+        node = self.branch(cur_data)
+        if node is None:
+            return PlanBase.SKIP
+        if node.kind is PlanBase.KIND_literal:
+            return node.literal
+        return node.value(root, cur_data if cur_data else g)
+
+
+class Plan_SwitchKey(Plan_IfKey):
+    """
+    branch of switch_key, one dict lookup whatever the number of cases
+    """
+
+    def __init__(self, path, amap, cases, default):
+        Plan_AMapBase.__init__(self, path, amap)
+        self._action = amap.action.parsed()
+        self._key = amap.action.argument_list[0]
+        self._cases = cases
+        self._default = default
+
+    def branch(self, cur_data):
+        if self._key not in cur_data:
+            self._action.check_data(cur_data)
+        return Action_SwitchKey.select(self._cases, cur_data[self._key],
+                                       self._default)
+
+    def branches(self):
+        branches = {}
+        for branch in self._cases.values() + [self._default]:
+            if branch is not None:
+                branches[id(branch)] = branch
+        return branches.values()
+
+
+class Plan_Lookup(Plan_AMapBase):
+    """
+    lookup row of the table index of AMLRunCache, template is plan node
+    or None
+    """
+
+    def __init__(self, path, amap, template):
+        super(Plan_Lookup, self).__init__(path, amap)
+        self._action = amap.action.parsed()
+        self._table_steps = self._action.table_steps()
+        self._key_field = amap.action.argument_list[1]
+        self._local_key = amap.action.argument_list[2]
+        self._template = template
+
+    def find(self, root, g, cache):
+        """
+        row, None or PlanBase.SKIP of missing row
+        """
+        row = self._action.find(root, self.cur_data(root, g), cache)
+        return PlanBase.SKIP if row is Action_Lookup.SKIP else row
+
+    def value(self, root, g):
+        row = self.find(root, g, AMLRunCache.current())
+        template = self._template
+        if row is None or row is PlanBase.SKIP or template is None:
+            return row
+        if template.kind is PlanBase.KIND_literal:
+            return template.literal
+        return template.value(root, row)
+
+
+class Plan_ForList(Plan_AMapBase):
+    kind = PlanBase.KIND_multi
+
+    def __init__(self, path, amap, item):
+        super(Plan_ForList, self).__init__(path, amap)
+        self._action = amap.action.parsed()
+        self.item = item
+        self.fields = self._flat_fields(item)
+
+    @staticmethod
+    def _flat_fields(item):
+        """
+        [(key, node)] of flat dict item template, None is not flat
+        """
+        if not isinstance(item, Plan_Dict):
+            return None
+        for key, node in item.children:
+            if not isinstance(node, (Plan_Literal, Plan_Static, Plan_MapKey,
+                                     Plan_MapIndex)):
+                return None
+        return list(item.children)
+
+    def list_data(self, root, g):
+        """
+        cur_data of the list, raise AMLDataError
+        """
+        cur_data = self.cur_data(root, g)
+        if not isinstance(cur_data, list):
+            self._action.check_data(cur_data)
+        return cur_data
+
+    def values(self, root, g):
+        cur_data = self.list_data(root, g)
+        item = self.item
+        if item.kind is PlanBase.KIND_literal:
+            return [item.literal for data_item in cur_data]
+        if self.fields is not None:
+            return self._rows(root, cur_data, g)
+        return [item.value(root, data_item if data_item else g)
+                for data_item in cur_data]
+
+    def columns(self, root, g):
+        """
+        {key: [field value of every item]} of flat item template
+        """
+        cur_data = self.list_data(root, g)
+        items = [data_item if data_item else g for data_item in cur_data]
+        return dict((key, Plan_ForList._column(root, items, node))
+                    for key, node in self.fields)
+
+    def _rows(self, root, cur_data, g):
+        items = [data_item if data_item else g for data_item in cur_data]
+        if not self.fields:
+            return [{} for data_item in items]
+        keys = [key for key, _ in self.fields]
+        columns = [Plan_ForList._column(root, items, node)
+                   for _, node in self.fields]
+        return [dict(itertools.izip(keys, row))
+                for row in itertools.izip(*columns)]
+
+    @staticmethod
+    def _column(root, items, node):
+        """
+        field value of all items in one pass
+        """
+        if node.kind is PlanBase.KIND_literal:
+            return [node.literal] * len(items)
+        if isinstance(node, Plan_MapKey) and not node._locations:
+            key, map_ = node._key, node.map
+            type_ = node._type
+            if type_:
+                return [type_(item[key]) if type(item) is dict and key in item
+                        else map_(item) for item in items]
+            return [item[key] if type(item) is dict and key in item
+                    else map_(item) for item in items]
+        return [node.value(root, item) for item in items]
+
+    def iter_values(self, root, g):
+        """
+        lazy values, one item of cur_data at a time
+        """
+        cur_data = self.list_data(root, g)
+        item = self.item
+        for data_item in cur_data:
+            if item.kind is PlanBase.KIND_literal:
+                yield item.literal
+            else:
+                yield item.value(root, data_item if data_item else g)
+
+
+class Plan_UnknownMap(Plan_AMapBase):
+    kind = PlanBase.KIND_stop
+
+    def stop(self, root, g):
+        self.cur_data(root, g)
+        logging.error('Unknow Amap %s !!!', self.amap)
+
+
+class AMLNodeStat(object):
+    """
+    profile stat of template node path
+    """
+
+    __slots__ = ('path', 'node_type', 'calls', 'total_time', 'self_time',
+                 'misses', 'type_time')
+
+    def __init__(self, path, node_type):
+        self.path = path
+        self.node_type = node_type
+        self.calls = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        # map_key and map_index miss
+        self.misses = 0
+        # time of AMLMap.type
+        self.type_time = 0.0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name in AMLNodeStat.__slots__)
+
+
+class AMLProfiler(object):
+    """
+    per template node profile of AML.run(..., profiler=AMLProfiler()),
+    node is identify by template path, e.g. 'represent_data[0].price',
+    for_list item is '[*]'
+
+    one profiler for one thread
+    """
+
+    REPORT_fields = ('calls', 'total_time', 'self_time', 'misses',
+                     'type_time')
+
+    def __init__(self):
+        self._stats = {}
+        # child time of running node
+        self._child_time = [0.0]
+
+    def stat(self, path, node_type):
+        stat = self._stats.get(path)
+        if stat is None:
+            stat = self._stats[path] = AMLNodeStat(path, node_type)
+        return stat
+
+    def enter(self):
+        self._child_time.append(0.0)
+        return timeit.default_timer()
+
+    def exit(self, stat, start):
+        elapsed = timeit.default_timer() - start
+        child_time = self._child_time.pop()
+        self._child_time[-1] += elapsed
+        stat.calls += 1
+        stat.total_time += elapsed
+        stat.self_time += elapsed - child_time
+
+    def report(self):
+        """
+        [stat dict] order by total_time
+        """
+        stats = sorted(self._stats.values(), key=lambda x: x.total_time,
+                       reverse=True)
+        return [stat.as_dict() for stat in stats]
+
+    def __str__(self):
+        lines = ['%-40s %-10s %8s %12s %12s %8s %12s' % (
+            ('path', 'node') + AMLProfiler.REPORT_fields)]
+        for stat in self.report():
+            lines.append('%-40s %-10s %8d %12.6f %12.6f %8d %12.6f' % (
+                stat['path'] or '<root>', stat['node_type'], stat['calls'],
+                stat['total_time'], stat['self_time'], stat['misses'],
+                stat['type_time']))
+        return '\n'.join(lines)
+
+
+class Plan_Profile(PlanBase):
+    """
+    profile wrapper of plan node
+    """
+
+    def __init__(self, node, profiler):
+        super(Plan_Profile, self).__init__(node.path)
+        self.node = node
+        self.kind = node.kind
+        self._profiler = profiler
+        self._stat = profiler.stat(node.path,
+                                   node.__class__.__name__.split('_', 1)[-1])
+
+    def value(self, root, g):
+        start = self._profiler.enter()
+        try:
+            return self.node.value(root, g)
+        finally:
+            self._profiler.exit(self._stat, start)
+
+    def locate(self, root, g):
+        start = self._profiler.enter()
+        try:
+            return self.node.locate(root, g)
+        finally:
+            self._profiler.exit(self._stat, start)
+
+    def values(self, root, g):
+        start = self._profiler.enter()
+        try:
+            return self.node.values(root, g)
+        finally:
+            self._profiler.exit(self._stat, start)
+
+    def stop(self, root, g):
+        start = self._profiler.enter()
+        try:
+            return self.node.stop(root, g)
+        finally:
+            self._profiler.exit(self._stat, start)
+
+
+class Plan_ProfileMap(Plan_Profile):
+    """
+    profile wrapper of Plan_MapKey and Plan_MapIndex, count miss and
+    type time
+    """
+
+    def __init__(self, node, profiler):
+        super(Plan_ProfileMap, self).__init__(node, profiler)
+        if isinstance(node, Plan_MapKey):
+            self._data_type = dict
+            self._item = node._key
+        else:
+            self._data_type = list
+            self._item = node._index
+
+    def _hit(self, cur_data):
+        if not isinstance(cur_data, self._data_type):
+            return False
+        if self._data_type is dict:
+            return self._item in cur_data
+        return self._item < len(cur_data)
+
+    def value(self, root, g):
+        node = self.node
+        stat = self._stat
+        start = self._profiler.enter()
+        try:
+            cur_data = node.cur_data(root, g)
+            if not self._hit(cur_data):
+                stat.misses += 1
+                return node.map(cur_data)
+            temp = cur_data[self._item]
+            if node._type:
+                type_start = timeit.default_timer()
+                temp = node._type(temp)
+                stat.type_time += timeit.default_timer() - type_start
+            return temp
+        finally:
+            self._profiler.exit(stat, start)
+
+
+class AMLCompiler(object):
+    """
+    template -> plan node tree
+
+    dict key order, amap kind and action type are fixed at compile time
+    profiler: AMLProfiler, wrap node to profile
+    """
+
+    def __init__(self, profiler=None, memo_size=0, share_static=False):
+        """
+        memo_size: container in for_list item is Plan_Memo
+        share_static: static dict and list is Plan_Literal of the
+                      prebuilt literal, else Plan_Static copy
+        """
+        self._profiler = profiler
+        self._memo_size = memo_size
+        self._share_static = share_static
+        # depth of for_list item
+        self._repeat = 0
+        # plan need AMLRunCache of run
+        self.run_cache = False
+
+    def compile(self, template):
+        return self._compile_node(template, '')
+
+    @staticmethod
+    def _join_path(path, key):
+        if isinstance(key, (int, long)):
+            return '%s[%s]' % (path, key)
+        return '%s.%s' % (path, key) if path else str(key)
+
+    def _compile_node(self, node, path):
+        node = self._create_node(node, path)
+        if self._profiler is None or node.kind is PlanBase.KIND_literal:
+            return node
+        if isinstance(node, (Plan_MapKey, Plan_MapIndex)):
+            return Plan_ProfileMap(node, self._profiler)
+        return Plan_Profile(node, self._profiler)
+
+    def _create_node(self, node, path):
+        if isinstance(node, (basestring, bool, int, long, float)):
+            return Plan_Literal(path, node)
+        static = AMLStateMachine.cached_static(node)
+        if static is not None:
+            if self._share_static:
+                return Plan_Literal(path, static.literal)
+            return Plan_Static(path, static)
+        if isinstance(node, dict):
+            return self._compile_dict(node, path)
+        elif isinstance(node, list):
+            return self._compile_list(node, path)
+        elif isinstance(node, AMLMap):
+            return self._compile_amap(node, path)
+        else:
+            raise AMLTemplateError("Unknow node: %r, template path '%s'" % (
+                node, path))
+
+    def _compile_dict(self, template, path):
+        children = []
+        dict_stack = copy.copy(AMLStateMachine.cached_map_order(template))
+        while dict_stack:
+            key = dict_stack.pop()
+            node = self._compile_node(template[key],
+                                      self._join_path(path, key))
+            children.append((key, node))
+            # unknow amap stop the dict
+            if node.kind is PlanBase.KIND_stop:
+                break
+        if self._memo([node for _, node in children]):
+            return Plan_MemoDict(path, children)
+        return Plan_Dict(path, children)
+
+    def _compile_list(self, template, path):
+        children = []
+        for idx, item in enumerate(template):
+            node = self._compile_node(item, self._join_path(path, idx))
+            children.append(node)
+            if node.kind is PlanBase.KIND_stop:
+                break
+        if self._memo(children):
+            return Plan_MemoList(path, children)
+        return Plan_List(path, children)
+
+    def _memo(self, children):
+        """
+        container of the children is Plan_Memo, in for_list item and
+        not all literal
+        """
+        if not (self._memo_size and self._repeat) or \
+           all(node.kind is PlanBase.KIND_literal for node in children):
+            return False
+        self.run_cache = True
+        return True
+
+    def _compile_branch(self, template, path):
+        if template is None:
+            return None
+        # no dict and list branch template assignment as it is
+        if not isinstance(template, (dict, list)):
+            return Plan_Literal(path, template)
+        return self._compile_node(template, path)
+
+    def _compile_amap(self, amap, path):
+        action = amap.action
+        if action:
+            action_state = action.action_state()
+            if action_state == AMLStateMachine.STATE_amlmap_action_location:
+                return Plan_Location(path, amap)
+            elif action_state == \
+                 AMLStateMachine.STATE_amlmap_action_root_location:
+                return Plan_Location(path, amap, root_location=True)
+            elif action_state == AMLStateMachine.STATE_amlmap_action_if_key:
+                action_obj = action.parsed()
+                return Plan_IfKey(
+                    path, amap,
+                    self._compile_branch(action_obj._block_template, path),
+                    self._compile_branch(action_obj._else_template, path))
+            elif action_state == AMLStateMachine.STATE_amlmap_action_switch_key:
+                action_obj = action.parsed()
+                # case of the same template share one node
+                nodes = {}
+                def compile_case(template):
+                    if id(template) not in nodes:
+                        nodes[id(template)] = self._compile_branch(template,
+                                                                   path)
+                    return nodes[id(template)]
+                cases = dict((value, compile_case(template)) for value, template
+                             in action_obj.cases().iteritems())
+                return Plan_SwitchKey(path, amap, cases,
+                                      compile_case(action_obj.default()))
+            elif action_state == AMLStateMachine.STATE_amlmap_action_lookup:
+                action_obj = action.parsed()
+                self.run_cache = True
+                return Plan_Lookup(path, amap, self._compile_branch(
+                    action_obj.template(), path))
+            elif action_state == AMLStateMachine.STATE_amlmap_action_for_list:
+                action_obj = action.parsed()
+                self._repeat += 1
+                try:
+                    item = self._compile_node(action_obj.template(),
+                                              path + '[*]')
+                finally:
+                    self._repeat -= 1
+                return Plan_ForList(path, amap, item)
+            raise AMLTemplateError("Unknow action: %s, template path '%s'" % (
+                action, path))
+        elif amap.key:
+            return Plan_MapKey(path, amap)
+        elif amap.index:
+            return Plan_MapIndex(path, amap)
+        return Plan_UnknownMap(path, amap)
+
+
+class AMLCodeCache(object):
+    """
+    on disk cache of codegen bytecode, a new process load the bytecode
+    of the generated source instead of compile it
+
+      only the python compile of the source is saved, a new process
+      still plan the template and generate the source, the key is the
+      generated source since the plan hold function of the template
+      (type, lambda ...) that has no stable fingerprint and can not save
+      file name is the fingerprint of the source, python bytecode
+      version and cache format, a changed template or aml generate
+      other source, so the file is never stale
+      bad file is a miss and compile again, fail to save is logged,
+      the cache is not required to run
+      counters: hits, misses, errors
+    """
+
+    # format of cache file
+    VERSION = 1
+    SUFFIX = '.amlc'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # other process make it
+                if not os.path.isdir(directory):
+                    raise
+
+    def fingerprint(self, source):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        digest = hashlib.sha1(imp.get_magic())
+        digest.update(str(AMLCodeCache.VERSION))
+        digest.update(source)
+        return digest.hexdigest()
+
+    def _file(self, source):
+        return os.path.join(self.directory,
+                            self.fingerprint(source) + AMLCodeCache.SUFFIX)
+
+    def load(self, source):
+        """
+        code of source, None is miss
+        """
+        try:
+            with open(self._file(source), 'rb') as fp:
+                code = marshal.load(fp)
+        except (IOError, EOFError, ValueError, TypeError):
+            code = None
+        if code is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return code
+
+    def save(self, source, code):
+        path = self._file(source)
+        try:
+            fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    marshal.dump(code, fp)
+                # reader never see a partial file
+                os.rename(temp, path)
+            except Exception:
+                os.remove(temp)
+                raise
+        except (IOError, OSError) as e:
+            self.errors += 1
+            logging.warning('aml code cache save %s failed: %s', path, e)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'errors': self.errors}
+
+    def __str__(self):
+        return '<AMLCodeCache at 0x%x directory:%s %s>' % (
+            id(self), self.directory, self.stats())
+
+    __repr__ = __str__
+
+
+class AMLCodeGenerator(object):
+    """
+    plan node tree -> python source, compile to one function
+
+      literal dict/list   -> python literal
+      key/index amap      -> subscript, miss fallback to plan node
+      location            -> straight-line subscripts
+      for_list            -> list comprehension
+      other plan node     -> call plan node
+    """
+
+    INDENT = '    '
+    # if_key block inline max depth, deeper to function
+    MAX_inline_depth = 40
+    LITERAL_types = (basestring, bool, int, long)
+
+    def __init__(self):
+        self._namespace = {'_SKIP': PlanBase.SKIP, '_memo': Plan_Memo.call}
+        self._const_names = {}
+        self._functions = []
+        self._var_idx = 0
+
+    def _var(self, prefix):
+        self._var_idx += 1
+        return '%s%s' % (prefix, self._var_idx)
+
+    def _const(self, value):
+        name = self._const_names.get(id(value))
+        if name is None:
+            name = self._var('_k')
+            self._const_names[id(value)] = name
+            self._namespace[name] = value
+        return name
+
+    def _literal(self, value):
+        if isinstance(value, self.LITERAL_types) or \
+           (isinstance(value, float) and value == value and
+            value not in (float('inf'), float('-inf'))):
+            return repr(value)
+        return self._const(value)
+
+    def _static(self, node):
+        """
+        source of static node, None is not static
+        """
+        if isinstance(node, Plan_Literal):
+            return self._literal(node.literal)
+        elif isinstance(node, Plan_Static):
+            if node.static.source is not None:
+                return node.static.source
+            return '%s()' % self._const(node.static.build)
+        elif isinstance(node, Plan_Dict):
+            items = []
+            for key, child in node.children:
+                child_source = self._static(child)
+                if child_source is None:
+                    return None
+                items.append('%s: %s' % (self._literal(key), child_source))
+            return '{%s}' % ', '.join(items)
+        elif isinstance(node, Plan_List):
+            items = []
+            for child in node.children:
+                child_source = self._static(child)
+                if child_source is None:
+                    return None
+                items.append(child_source)
+            return '[%s]' % ', '.join(items)
+        return None
+
+    def generate(self, plan, name='template', code_cache=None):
+        """
+        return (source, function(root, g))
+        code_cache: AMLCodeCache, load or save bytecode of the source
+        """
+        entry = self._function(plan)
+        source = '\n\n'.join('\n'.join(lines) for lines in self._functions)
+        code = None if code_cache is None else code_cache.load(source)
+        if code is None:
+            code = compile(source + '\n', '<aml %s>' % name, 'exec')
+            if code_cache is not None:
+                code_cache.save(source, code)
+        exec(code, self._namespace)
+        return source, self._namespace[entry]
+
+    def _function(self, node):
+        name = self._var('_f')
+        lines = ['def %s(root, g):' % name]
+        self._functions.append(lines)
+        result = self._static(node)
+        if result is None:
+            result = self._emit_container(node, 'g', lines, 1)
+        lines.append('%sreturn %s' % (self.INDENT, result))
+        return name
+
+    def _emit_container(self, node, g_expr, lines, depth):
+        indent = self.INDENT * depth
+        g = self._var('g')
+        result = self._var('r')
+        lines.append('%s%s = %s or root' % (indent, g, g_expr))
+        if isinstance(node, Plan_Dict):
+            lines.append('%s%s = {}' % (indent, result))
+            for key, child in node.children:
+                assign = '%s[%s] = %%s' % (
+                    result, self._literal(key).replace('%', '%%'))
+                g = self._emit_child(child, assign, result, True, g, lines,
+                                     depth)
+        else:
+            lines.append('%s%s = []' % (indent, result))
+            for child in node.children:
+                assign = '%s.append(%%s)' % result
+                g = self._emit_child(child, assign, result, False, g, lines,
+                                     depth)
+        return result
+
+    def _subscripts(self, base, locations):
+        return base + ''.join('[%s]' % self._literal(loc)
+                              for loc in locations)
+
+    def _cur_data(self, node, g, lines, indent):
+        base = 'root' if node._is_root else g
+        if not node._locations:
+            return base
+        cur_data = self._var('c')
+        lines.append('%s%s = %s' % (indent, cur_data,
+                                    self._subscripts(base, node._locations)))
+        return cur_data
+
+    def _emit_value(self, node, assign, g, lines, depth):
+        """
+        container node or literal node assignment
+        """
+        indent = self.INDENT * depth
+        source = self._static(node)
+        if source is None:
+            if depth >= self.MAX_inline_depth or isinstance(node, Plan_Memo):
+                source = self._call(node, g)
+            else:
+                source = self._emit_container(node, g, lines, depth)
+        lines.append(indent + assign % source)
+
+    def _call(self, node, g):
+        """
+        source of node function call, Plan_Memo by the memo
+        """
+        if isinstance(node, Plan_Memo):
+            return '_memo(%s, %s, root, %s)' % (self._const(node),
+                                                self._function(node), g)
+        return '%s(root, %s)' % (self._function(node), g)
+
+    def _emit_child(self, child, assign, result, is_dict, g, lines, depth):
+        """
+        assign: assignment source format of result
+        return container g after the child
+        """
+        indent = self.INDENT * depth
+        sub_indent = self.INDENT * (depth + 1)
+        if isinstance(child, (Plan_Literal, Plan_Dict, Plan_List)):
+            self._emit_value(child, assign, g, lines, depth)
+
+        elif isinstance(child, (Plan_MapKey, Plan_MapIndex)):
+            cur_data = self._cur_data(child, g, lines, indent)
+            if isinstance(child, Plan_MapKey):
+                item = self._literal(child._key)
+                lines.append('%sif type(%s) is dict and %s in %s:' % (
+                    indent, cur_data, item, cur_data))
+            else:
+                item = self._literal(child._index)
+                lines.append('%sif type(%s) is list and %s < len(%s):' % (
+                    indent, cur_data, item, cur_data))
+            temp = '%s[%s]' % (cur_data, item)
+            if child._type:
+                temp = '%s(%s)' % (self._const(child._type), temp)
+            lines.append(sub_indent + assign % temp)
+            lines.append('%selse:' % indent)
+            lines.append(sub_indent + assign % (
+                '%s.map(%s)' % (self._const(child), cur_data)))
+
+        elif isinstance(child, Plan_Location):
+            # amap location only check the path
+            self._cur_data(child, g, lines, indent)
+            base = 'root' if child._action_root else g
+            lines.append('%s%s = %s' % (indent, g, self._subscripts(
+                base, child._action_locations)))
+
+        elif isinstance(child, Plan_SwitchKey):
+            cur_data = self._cur_data(child, g, lines, indent)
+            key = self._literal(child._key)
+            lines.append('%sif %s not in %s:' % (indent, key, cur_data))
+            lines.append('%s%s(%s)' % (sub_indent,
+                                       self._const(child._action.check_data),
+                                       cur_data))
+            cases, default = self._switch_table(child)
+            branch = self._var('b')
+            lines.append('%stry:' % indent)
+            lines.append('%s%s = %s.get(%s[%s], %s)' % (
+                sub_indent, branch, cases, cur_data, key, default))
+            lines.append('%sexcept TypeError:' % indent)
+            lines.append('%s%s = %s' % (sub_indent, branch, default))
+            lines.append('%sif %s is not None:' % (indent, branch))
+            lines.append(sub_indent + assign % '%s(root, %s or %s)' % (
+                branch, cur_data, g))
+
+        elif isinstance(child, Plan_IfKey):
+            cur_data = self._cur_data(child, g, lines, indent)
+            if cur_data == g:
+                # g may change by location
+                cur_data = self._var('c')
+                lines.append('%s%s = %s' % (indent, cur_data, g))
+            key = self._literal(child._key)
+            lines.append('%sif %s not in %s:' % (indent, key, cur_data))
+            lines.append('%s%s(%s)' % (sub_indent,
+                                       self._const(child._action.check_data),
+                                       cur_data))
+            lines.append('%sif %s[%s] %s %s:' % (indent, cur_data, key,
+                                                 child._op,
+                                                 self._literal(child._value)))
+            self._emit_branch(child._block, assign, cur_data, g, lines,
+                              depth + 1)
+            lines.append('%selse:' % indent)
+            self._emit_branch(child._else, assign, cur_data, g, lines,
+                              depth + 1)
+
+        elif isinstance(child, Plan_ForList):
+            cur_data = self._cur_data(child, g, lines, indent)
+            data_item = self._var('d')
+            lines.append('%sif not isinstance(%s, list):' % (indent, cur_data))
+            lines.append('%s%s(%s)' % (sub_indent,
+                                       self._const(child._action.check_data),
+                                       cur_data))
+            item = child.item
+            temp = self._static(item)
+            if temp is None:
+                temp = self._call(item, '%s or %s' % (data_item, g))
+            if is_dict:
+                lines.append('%sfor %s in %s:' % (indent, data_item, cur_data))
+                lines.append(sub_indent + assign % temp)
+            else:
+                lines.append('%s%s.extend([%s for %s in %s])' % (
+                    indent, result, temp, data_item, cur_data))
+
+        else:
+            self._emit_plan_call(child, assign, g, lines, depth)
+        return g
+
+    def _switch_table(self, node):
+        """
+        (cases dict name, default function name) of switch_key, dict of
+        value -> branch function
+        """
+        functions = {}
+        for branch in node.branches():
+            functions[id(branch)] = self._function(branch)
+        default = functions[id(node._default)] \
+                  if node._default is not None else 'None'
+        cases = self._var('_s')
+        self._functions.append(['%s = {%s}' % (cases, ', '.join(
+            '%s: %s' % (self._literal(value), functions.get(id(branch),
+                                                             'None'))
+            for value, branch in node._cases.iteritems()))])
+        return cases, default
+
+    def _emit_branch(self, node, assign, cur_data, g, lines, depth):
+        if node is None:
+            lines.append('%spass' % (self.INDENT * depth))
+        else:
+            self._emit_value(node, assign, '%s or %s' % (cur_data, g),
+                             lines, depth)
+
+    def _emit_plan_call(self, child, assign, g, lines, depth):
+        indent = self.INDENT * depth
+        sub_indent = self.INDENT * (depth + 1)
+        node = self._const(child)
+        kind = child.kind
+        if kind is PlanBase.KIND_value:
+            temp = self._var('t')
+            lines.append('%s%s = %s.value(root, %s)' % (indent, temp, node, g))
+            lines.append('%sif %s is not _SKIP:' % (indent, temp))
+            lines.append(sub_indent + assign % temp)
+        elif kind is PlanBase.KIND_location:
+            lines.append('%s%s = %s.locate(root, %s)' % (indent, g, node, g))
+        elif kind is PlanBase.KIND_multi:
+            temp = self._var('t')
+            lines.append('%sfor %s in %s.values(root, %s):' % (indent, temp,
+                                                              node, g))
+            lines.append(sub_indent + assign % temp)
+        else:
+            lines.append('%s%s.stop(root, %s)' % (indent, node, g))
+
+
+class AMLTemplate(object):
+    """
+    compiled template, run many times with different data
+
+    backend:
+      plan    -> run plan node tree
+      codegen -> run python function generate from plan node tree
+    """
+
+    BACKEND_plan = 'plan'
+    BACKEND_codegen = 'codegen'
+
+    def __init__(self, template, plan, backend=BACKEND_plan, run_cache=False,
+                 memo_size=0, code_cache=None):
+        """
+        run_cache: plan need AMLRunCache of every run (lookup, memo)
+        memo_size: memo cap of a run, see Plan_Memo
+        code_cache: AMLCodeCache of codegen backend
+        """
+        assert backend in (AMLTemplate.BACKEND_plan,
+                           AMLTemplate.BACKEND_codegen), \
+               "Unknow backend: '%s'" % backend
+        self.template = template
+        self.plan = plan
+        self.backend = backend
+        self.source = None
+        self.run_cache = run_cache
+        self.memo_size = memo_size
+        self._function = None
+        self._writer = None
+        self._read_set = None
+        if backend == AMLTemplate.BACKEND_codegen and \
+           isinstance(plan, (Plan_Dict, Plan_List)):
+            self.source, self._function = AMLCodeGenerator().generate(
+                plan, code_cache=code_cache)
+
+    def run(self, data, errors=None):
+        """
+        errors: AMLErrorCollector of map miss
+        """
+        if errors is None:
+            return self._run(data)
+        previous = AMLErrorCollector.set_current(errors)
+        try:
+            return self._run(data)
+        finally:
+            AMLErrorCollector.set_current(previous)
+
+    def _run(self, data):
+        if self.run_cache:
+            return AMLRunCache(self.memo_size).run(self._run_plan, data)
+        return self._run_plan(data)
+
+    def _run_plan(self, data):
+        if self._function is not None:
+            return self._function(data, data)
+        plan = self.plan
+        if plan.kind is PlanBase.KIND_literal:
+            return plan.literal
+        if plan.kind is not PlanBase.KIND_value:
+            return None
+        result = plan.value(data, data)
+        return None if result is PlanBase.SKIP else result
+
+    def run_lazy(self, data):
+        """
+        read only lazy view of run result, see AMLLazyView
+        """
+        cache = AMLRunCache(self.memo_size) if self.run_cache else None
+        result = AMLLazyView.view(self.plan, data, data, cache)
+        return None if result is PlanBase.SKIP else result
+
+    def dump(self, data, fp):
+        """
+        write json of run result to fp, for_list item is write when
+        produced, not build the result first
+        """
+        if self._writer is None:
+            self._writer = AMLJSONWriter(self.plan)
+        if self.run_cache:
+            AMLRunCache(self.memo_size).run(self._writer.dump, data, fp)
+        else:
+            self._writer.dump(data, fp)
+
+    def read_set(self):
+        """
+        AMLReadSet of the data read by template
+        """
+        if self._read_set is None:
+            self._read_set = AMLReadSet.from_plan(self.plan)
+        return self._read_set
+
+    def for_list_target(self, path=None):
+        """
+        (node, data_steps, g_steps) of the for_list of data path, path
+        can be None when template has one for_list
+        """
+        targets = self.for_list_targets()
+        if path is not None:
+            steps = AMLPath.parse(path) if path else ()
+            targets = [target for target in targets if target[1] == steps]
+        if len(targets) != 1:
+            raise AMLTemplateError(
+                "need one for_list of path %r, for_list paths: %s" % (
+                path, [str(AMLPath(target[1])) for target in
+                       self.for_list_targets()]))
+        return targets[0]
+
+    @staticmethod
+    def stream_reads(node, steps):
+        """
+        [(path, whole)] data read by for_list item template out of the
+        items of the array of steps, falsy item fallback is not count
+        """
+        items = steps + (AMLReadSet.ITEMS,)
+        read_set = AMLReadSet(root_fallback=False)
+        read_set._analyze(node.item, set([items]))
+        return [(path, whole) for path, whole in read_set.paths()
+                if path[:len(items)] != items]
+
+    @staticmethod
+    def check_stream(node, steps, root):
+        """
+        raise AMLTemplateError of item template read data not load by
+        the stream, root is the document before the array of steps,
+        the data may be after the array or not in the document
+        """
+        for path, whole in AMLTemplate.stream_reads(node, steps):
+            data = root
+            for depth, step in enumerate(path):
+                if depth < len(steps) and step == steps[depth]:
+                    data = data[step]
+                    continue
+                # out of the array path, load if before the array
+                if depth < len(steps) and (
+                    step in data if isinstance(data, dict) else
+                    isinstance(step, (int, long)) and 0 <= step < len(data)):
+                    break
+                raise AMLTemplateError(
+                    "stream item template read '%s', the data after the "
+                    "array '%s' is not load" % (AMLPath(path), AMLPath(steps)))
+            else:
+                # ancestor of the array is load before the array only
+                if whole:
+                    raise AMLTemplateError(
+                        "stream item template read all of '%s', the data "
+                        "after the array '%s' is not load" % (
+                        AMLPath(path) if path else 'root', AMLPath(steps)))
+
+    @staticmethod
+    def target_g(root, g_steps):
+        try:
+            return AMLPath(g_steps).get(root) or root
+        except (LookupError, TypeError):
+            return root
+
+    @staticmethod
+    def column_array(column, type_, use_numpy=True):
+        """
+        numpy array, array of int, float type field, or list
+        """
+        if use_numpy and numpy is not None:
+            return numpy.array(column)
+        typecode = {int: 'l', float: 'd'}.get(type_)
+        if typecode is not None:
+            try:
+                return array.array(typecode, column)
+            except (TypeError, OverflowError):
+                # miss field is None
+                pass
+        return column
+
+    def for_list_targets(self):
+        """
+        [(node, data_steps, g_steps)] of for_list in dict and list,
+        data_steps is the static path of the for_list list from root
+        data, g_steps is the path of g at the for_list
+        """
+        targets = []
+        AMLTemplate._for_list_targets(self.plan, (), targets)
+        return targets
+
+    @staticmethod
+    def _for_list_targets(node, g_steps, targets):
+        if isinstance(node, Plan_Dict):
+            children = [child for _, child in node.children]
+        elif isinstance(node, Plan_List):
+            children = node.children
+        else:
+            return
+        for child in children:
+            if isinstance(child, Plan_Location):
+                g_steps = (() if child._action_root else g_steps) + \
+                          child._action_locations
+            elif isinstance(child, Plan_ForList):
+                data_steps = (() if child._is_root else g_steps) + \
+                             child._locations
+                targets.append((child, data_steps, g_steps))
+            else:
+                AMLTemplate._for_list_targets(child, g_steps, targets)
+
+
+class AMLReadSet(object):
+    """
+    path tree of data read by template, static analysis of plan
+
+      children: {key or index: AMLReadSet}
+      items: AMLReadSet of every list item (for_list), path step '*'
+      whole: the data and everything under it is read
+      no children and not whole: only the data object is read
+    """
+
+    __slots__ = ('children', 'items', 'whole', '_merged', '_root_fallback')
+
+    ITEMS = '*'
+
+    def __init__(self, root_fallback=True):
+        """
+        root_fallback: read of root by falsy g of container, False is
+                       not count it
+        """
+        self.children = {}
+        self.items = None
+        self.whole = False
+        self._merged = {}
+        self._root_fallback = root_fallback
+
+    @staticmethod
+    def from_plan(plan):
+        read_set = AMLReadSet()
+        read_set._analyze(plan, set([()]))
+        return read_set
+
+    def add(self, path, whole=False):
+        node = self
+        for step in path:
+            if node.whole:
+                return
+            if step == AMLReadSet.ITEMS:
+                if node.items is None:
+                    node.items = AMLReadSet()
+                node = node.items
+            else:
+                node = node.children.setdefault(step, AMLReadSet())
+        node.whole = node.whole or whole
+
+    def item(self, index):
+        """
+        read set of list item index
+        """
+        child = self.children.get(index)
+        if child is None or self.items is None:
+            return self.items if child is None else child
+        merged = self._merged.get(index)
+        if merged is None:
+            merged = self._merged[index] = AMLReadSet()
+            for path, whole in itertools.chain(child.paths(),
+                                               self.items.paths()):
+                merged.add(path, whole)
+        return merged
+
+    def project(self, data):
+        """
+        keep only the read data, a not read dict key is drop, a dict
+        of all key drop keep one key of None for the truth value, a not
+        read list item is None for the index
+        """
+        if self.whole:
+            return data
+        if isinstance(data, dict):
+            result = {}
+            for key, child in self.children.items():
+                if key in data:
+                    result[key] = child.project(data[key])
+            if not result and data:
+                result[next(iter(data))] = None
+            return result
+        if isinstance(data, list):
+            if not self.children:
+                if self.items is None:
+                    return [None] * len(data)
+                items = self.items
+                return [items.project(item) for item in data]
+            result = []
+            for index, item in enumerate(data):
+                child = self.item(index)
+                result.append(None if child is None else child.project(item))
+            return result
+        return data
+
+    def paths(self, prefix=()):
+        """
+        [(path, whole)] of the leaf
+        """
+        if self.whole or (not self.children and self.items is None):
+            return [(prefix, self.whole)]
+        result = []
+        for step, child in self.children.items():
+            result.extend(child.paths(prefix + (step,)))
+        if self.items is not None:
+            result.extend(self.items.paths(prefix + (AMLReadSet.ITEMS,)))
+        return result
+
+    def __str__(self):
+        lines = []
+        for path, whole in self.paths():
+            text = str(AMLPath(path)).replace('.*', '[*]')
+            if text.startswith('*'):
+                text = '[*]' + text[1:]
+            lines.append(text if whole else text + ' (shallow)')
+        return '\n'.join(sorted(lines))
+
+    __repr__ = __str__
+
+    ### static analysis, g_paths is all path g can be
+
+    @staticmethod
+    def _cur_paths(node, g_paths):
+        if node._is_root:
+            return set([node._locations])
+        return set(g_path + node._locations for g_path in g_paths)
+
+    def _analyze(self, node, g_paths):
+        if node.kind is PlanBase.KIND_literal or isinstance(node, Plan_Static):
+            return
+        if isinstance(node, (Plan_Dict, Plan_List)):
+            self._analyze_container(node, g_paths)
+        elif isinstance(node, (Plan_MapKey, Plan_MapIndex)):
+            key = node._key if isinstance(node, Plan_MapKey) else node._index
+            for cur_path in self._cur_paths(node, g_paths):
+                self.add(cur_path + (key,), True)
+        elif isinstance(node, Plan_IfKey):
+            cur_paths = self._cur_paths(node, g_paths)
+            for cur_path in cur_paths:
+                self.add(cur_path)
+                self.add(cur_path + (node._key,), True)
+            # branch g is cur_data or g when cur_data is falsy
+            for branch in node.branches():
+                self._analyze(branch, cur_paths | g_paths)
+        elif isinstance(node, Plan_Lookup):
+            for cur_path in self._cur_paths(node, g_paths):
+                self.add(cur_path)
+                self.add(cur_path + (node._local_key,), True)
+            rows = node._table_steps + (AMLReadSet.ITEMS,)
+            self.add(rows + (node._key_field,), True)
+            if node._template is None:
+                self.add(rows, True)
+            else:
+                self._analyze(node._template, set([rows]))
+        else:
+            # unknow node, read all data
+            self.add((), True)
+
+    def _analyze_container(self, node, g_paths):
+        # falsy g is root at container start
+        if self._root_fallback:
+            g_paths = g_paths | set([()])
+        if isinstance(node, Plan_Dict):
+            children = [child for _, child in node.children]
+        else:
+            children = node.children
+        for child in children:
+            kind = child.kind
+            if kind is PlanBase.KIND_location:
+                for cur_path in self._cur_paths(child, g_paths):
+                    self.add(cur_path)
+                if child._action_root:
+                    g_paths = set([child._action_locations])
+                else:
+                    g_paths = set(g_path + child._action_locations
+                                  for g_path in g_paths)
+                for g_path in g_paths:
+                    self.add(g_path)
+            elif kind is PlanBase.KIND_multi:
+                cur_paths = self._cur_paths(child, g_paths)
+                for cur_path in cur_paths:
+                    self.add(cur_path)
+                # falsy item is g
+                self._analyze(child.item, g_paths | set(
+                    cur_path + (AMLReadSet.ITEMS,) for cur_path in cur_paths))
+            elif kind is PlanBase.KIND_stop:
+                for cur_path in self._cur_paths(child, g_paths):
+                    self.add(cur_path)
+            else:
+                self._analyze(child, g_paths)
+
+
+class AMLStreamList(list):
+    """
+    json array of AMLJSONStream, item is decoded when iterate, so only
+    one item in memory, iterate once, len() is 0
+    """
+
+    __slots__ = ('_stream', '_empty', '_consumed')
+
+    def __init__(self, stream):
+        super(AMLStreamList, self).__init__()
+        self._stream = stream
+        self._empty = stream._peek() == ']'
+        self._consumed = False
+
+    def __iter__(self):
+        assert not self._consumed, 'stream list can only iterate once'
+        self._consumed = True
+        return self._stream._iter_array()
+
+    def __nonzero__(self):
+        return not self._empty
+
+    __bool__ = __nonzero__
+
+
+class AMLJSONStream(object):
+    """
+    incremental json reader of file or byte stream
+
+      locate(path) load the document before the array at path, the
+      array is a AMLStreamList, the data after the array is not read
+      buffer only keep the unread text of the stream
+      malformed json raise ValueError, document has no data of the
+      path raise AMLDataError
+    """
+
+    WHITESPACE_re = re.compile(r'[ \t\n\r]*')
+    NUMBER_tail_re = re.compile(r'[-+.eE0-9]*')
+
+    def __init__(self, fp, chunk_size=65536):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._json_decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        read more text, grow with the buffer for big value
+        """
+        if self._eof:
+            return
+        buf = self._buf[self._pos:]
+        chunk = self._fp.read(max(self._chunk_size, len(buf)))
+        if not chunk:
+            self._eof = True
+        if isinstance(chunk, bytes):
+            chunk = self._text_decoder.decode(chunk, self._eof)
+        self._buf = buf + chunk
+        self._pos = 0
+
+    def _peek(self):
+        """
+        next char after whitespace, '' is end of stream
+        """
+        while True:
+            self._pos = AMLJSONStream.WHITESPACE_re.match(self._buf,
+                                                          self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                return ''
+            self._fill()
+
+    def _next(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("json stream expect '%s' but '%s'" % (chars,
+                                                                   char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buf,
+                                                           self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            # number at the end of buffer may be not complete: 1.|5
+            if self._eof or not isinstance(value, (int, long, float)) or \
+               AMLJSONStream.NUMBER_tail_re.match(self._buf, end).end() < \
+               len(self._buf):
+                self._pos = end
+                return value
+            self._fill()
+
+    def _skip(self):
+        """
+        skip a value, container is decode one child at a time
+        """
+        char = self._peek()
+        if char == '[':
+            self._pos += 1
+            end = self._peek() == ']'
+            if end:
+                self._pos += 1
+            while not end:
+                self._value()
+                end = self._next(',]') == ']'
+        elif char == '{':
+            self._pos += 1
+            end = self._peek() == '}'
+            if end:
+                self._pos += 1
+            while not end:
+                self._value()
+                self._next(':')
+                self._value()
+                end = self._next(',}') == '}'
+        else:
+            self._value()
+
+    def load(self, read_set=None):
+        """
+        decode the document, only keep data of read_set (AMLReadSet)
+
+          dict on the path is decode key by key, list item is decode
+          one at a time and project by AMLReadSet.project
+        """
+        if read_set is None:
+            return self._value()
+        return self._project(read_set)
+
+    def _project(self, read_set):
+        if read_set.whole:
+            return self._value()
+        char = self._peek()
+        if char == '{':
+            self._pos += 1
+            result = {}
+            drop_key = None
+            end = self._peek() == '}'
+            if end:
+                self._pos += 1
+            while not end:
+                key = self._value()
+                self._next(':')
+                child = read_set.children.get(key)
+                if child is None:
+                    self._skip()
+                    if drop_key is None:
+                        drop_key = key
+                else:
+                    result[key] = self._project(child)
+                end = self._next(',}') == '}'
+            if not result and drop_key is not None:
+                result[drop_key] = None
+            return result
+        if char == '[':
+            self._pos += 1
+            result = []
+            end = self._peek() == ']'
+            if end:
+                self._pos += 1
+            while not end:
+                child = read_set.item(len(result))
+                if child is None:
+                    self._skip()
+                    result.append(None)
+                else:
+                    result.append(child.project(self._value()))
+                end = self._next(',]') == ']'
+            return result
+        return self._value()
+
+    def _iter_array(self):
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._next(',]') == ']':
+                return
+
+    def locate(self, path):
+        """
+        path: data path of the array, AMLPath source or steps
+        return (document, array)
+        """
+        steps = AMLPath.parse(path) if path else ()
+        return self._locate(steps, 0)
+
+    def _locate(self, steps, depth):
+        if depth == len(steps):
+            self._next('[')
+            array = AMLStreamList(self)
+            return array, array
+
+        step = steps[depth]
+        if self._next('{[') == '{':
+            document = {}
+            end = self._peek() == '}'
+            while not end:
+                key = self._value()
+                self._next(':')
+                if key == step:
+                    document[key], array = self._locate(steps, depth + 1)
+                    return document, array
+                document[key] = self._value()
+                end = self._next(',}') == '}'
+        else:
+            document = []
+            end = self._peek() == ']'
+            while not end:
+                if len(document) == step:
+                    item, array = self._locate(steps, depth + 1)
+                    document.append(item)
+                    return document, array
+                document.append(self._value())
+                end = self._next(',]') == ']'
+        raise AMLDataError("json stream no data of path %s" %
+                           AMLPath(steps[:depth + 1]))
+
+
+class AMLJSONWriter(object):
+    """
+    write json of compiled plan result to stream as node produced, the
+    json is same as json.dump(AMLTemplate.run(data), fp) but dict key
+    in template run order
+
+      key fragment and literal node is encode once by template
+      item of for_list in list is write to fp when produced
+      for_list in dict is the last item, same as run
+    kwargs: json.JSONEncoder arguments, no indent
+    """
+
+    def __init__(self, plan, **kwargs):
+        assert not kwargs.get('indent'), 'AMLJSONWriter no support indent'
+        self._encoder = json.JSONEncoder(**kwargs)
+        self._write_root = self._compile(plan)
+
+    def dump(self, data, fp):
+        out = []
+        if not self._write_root(data, data, out, fp):
+            out.append('null')
+        fp.write(''.join(out))
+
+    def dumps(self, data):
+        out = []
+        if not self._write_root(data, data, out, None):
+            out.append('null')
+        return ''.join(out)
+
+    ### compile node to write(root, g, out, fp), out is text not
+    ### write to fp yet, return False is no value
+
+    def _compile(self, node):
+        kind = node.kind
+        if kind is PlanBase.KIND_literal:
+            return self._compile_literal(node.literal)
+        if isinstance(node, Plan_Static):
+            return self._compile_literal(node.static.literal)
+        if kind is not PlanBase.KIND_value:
+            return lambda root, g, out, fp: False
+        if isinstance(node, Plan_Dict):
+            return self._compile_dict(node)
+        if isinstance(node, Plan_List):
+            return self._compile_list(node)
+        if isinstance(node, Plan_IfKey):
+            return self._compile_if_key(node)
+        return self._compile_value(node)
+
+    def _compile_literal(self, literal):
+        text = self._encoder.encode(literal)
+
+        def write(root, g, out, fp):
+            out.append(text)
+            return True
+        return write
+
+    def _compile_value(self, node):
+        encode = self._encoder.encode
+        value = node.value
+
+        def write(root, g, out, fp):
+            temp = value(root, g)
+            if temp is PlanBase.SKIP:
+                return False
+            out.append(encode(temp))
+            return True
+        return write
+
+    def _compile_if_key(self, node):
+        branches = {}
+        for branch in node.branches():
+            branches[id(branch)] = self._compile(branch)
+
+        def write(root, g, out, fp):
+            cur_data = node.cur_data(root, g)
+            branch = node.branch(cur_data)
+            if branch is None:
+                return False
+            return branches[id(branch)](root, cur_data if cur_data else g,
+                                        out, fp)
+        return write
+
+    def _compile_dict(self, node):
+        encoder = self._encoder
+        key_separator = encoder.key_separator
+        item_separator = encoder.item_separator
+        children = []
+        for key, child in node.children:
+            # json key is string
+            if not isinstance(key, basestring):
+                key = encoder.encode(key)
+            fragment = encoder.encode(key) + key_separator
+            write_child = None
+            if child.kind in (PlanBase.KIND_literal, PlanBase.KIND_value):
+                write_child = self._compile(child)
+            children.append((fragment, child.kind, child, write_child))
+
+        def write(root, g, out, fp):
+            if not g:
+                g = root
+            out.append('{')
+            separator = ''
+            for fragment, kind, child, write_child in children:
+                if write_child is not None:
+                    out.append(separator + fragment)
+                    if write_child(root, g, out, fp):
+                        separator = item_separator
+                    else:
+                        out.pop()
+                elif kind is PlanBase.KIND_location:
+                    g = child.locate(root, g)
+                elif kind is PlanBase.KIND_multi:
+                    # dict key assign by every item, the last one win
+                    temp = PlanBase.SKIP
+                    for temp in child.iter_values(root, g):
+                        pass
+                    if temp is not PlanBase.SKIP:
+                        out.append(separator + fragment)
+                        out.append(encoder.encode(temp))
+                        separator = item_separator
+                else:
+                    child.stop(root, g)
+            out.append('}')
+            return True
+        return write
+
+    def _compile_list(self, node):
+        item_separator = self._encoder.item_separator
+        children = []
+        for child in node.children:
+            write_child = None
+            if child.kind in (PlanBase.KIND_literal, PlanBase.KIND_value):
+                write_child = self._compile(child)
+            elif child.kind is PlanBase.KIND_multi:
+                write_child = self._compile(child.item)
+            children.append((child.kind, child, write_child))
+
+        def write(root, g, out, fp):
+            if not g:
+                g = root
+            out.append('[')
+            separator = ''
+            for kind, child, write_child in children:
+                if kind is PlanBase.KIND_location:
+                    g = child.locate(root, g)
+                elif kind is PlanBase.KIND_multi:
+                    cur_data = child.list_data(root, g)
+                    for data_item in cur_data:
+                        out.append(separator)
+                        write_child(root, data_item if data_item else g,
+                                    out, fp)
+                        separator = item_separator
+                        if fp is not None:
+                            # flush the item
+                            fp.write(''.join(out))
+                            del out[:]
+                elif write_child is not None:
+                    out.append(separator)
+                    if write_child(root, g, out, fp):
+                        separator = item_separator
+                    else:
+                        out.pop()
+                else:
+                    child.stop(root, g)
+            out.append(']')
+            return True
+        return write
+
+
+class AMLLazyView(object):
+    """
+    base of read only lazy result view of compiled plan, node value is
+    evaluate on first access and cached
+
+      g of a child is moved by the location before it in run order,
+      same as AMLStateMachine
+    """
+
+    def __init__(self, node, root, g, cache=None):
+        self._node = node
+        self._root = root
+        # container start
+        self._g = g if g else root
+        self._values = {}
+        # AMLRunCache of the view run
+        self._cache = cache
+
+    @staticmethod
+    def view(node, root, g, cache=None):
+        """
+        lazy value of node, PlanBase.SKIP is no value
+        """
+        kind = node.kind
+        if kind is PlanBase.KIND_literal:
+            return node.literal
+        if kind is not PlanBase.KIND_value:
+            return PlanBase.SKIP
+        if isinstance(node, Plan_Dict):
+            return AMLLazyDict(node, root, g, cache)
+        if isinstance(node, Plan_List):
+            return AMLLazyList(node, root, g, cache)
+        if isinstance(node, Plan_IfKey):
+            cur_data = node.cur_data(root, g)
+            branch = node.branch(cur_data)
+            if branch is None:
+                return PlanBase.SKIP
+            return AMLLazyView.view(branch, root, cur_data if cur_data else g,
+                                    cache)
+        if isinstance(node, Plan_Lookup):
+            row = node.find(root, g, cache)
+            if row is None or row is PlanBase.SKIP or node._template is None:
+                return row
+            return AMLLazyView.view(node._template, root, row, cache)
+        return node.value(root, g)
+
+    @staticmethod
+    def materialize(value):
+        """
+        plain dict, list of value, evaluate all the view
+        """
+        if isinstance(value, AMLLazyDict):
+            return dict((key, AMLLazyView.materialize(item))
+                        for key, item in value.items())
+        if isinstance(value, AMLLazyList):
+            return [AMLLazyView.materialize(item) for item in value]
+        return value
+
+    def __repr__(self):
+        return repr(AMLLazyView.materialize(self))
+
+
+class AMLLazyDict(AMLLazyView, collections.Mapping):
+    """
+    lazy dict result of Plan_Dict
+    """
+
+    def __init__(self, node, root, g, cache=None):
+        super(AMLLazyDict, self).__init__(node, root, g, cache)
+        # _gs[i] is g of children[i]
+        self._gs = [self._g]
+
+    def _child_g(self, idx):
+        gs = self._gs
+        children = self._node.children
+        while len(gs) <= idx:
+            child = children[len(gs) - 1][1]
+            if child.kind is PlanBase.KIND_location:
+                gs.append(child.locate(self._root, gs[-1]))
+            else:
+                gs.append(gs[-1])
+        return gs[idx]
+
+    def _value(self, idx):
+        """
+        value of children[idx], PlanBase.SKIP is no key
+        """
+        if idx in self._values:
+            return self._values[idx]
+        child = self._node.children[idx][1]
+        g = self._child_g(idx)
+        kind = child.kind
+        if kind is PlanBase.KIND_multi:
+            # dict key assign by every item, the last one win
+            cur_data = child.list_data(self._root, g)
+            value = PlanBase.SKIP
+            if cur_data:
+                data_item = cur_data[-1]
+                value = AMLLazyView.view(child.item, self._root,
+                                         data_item if data_item else g,
+                                         self._cache)
+        elif kind is PlanBase.KIND_stop:
+            child.stop(self._root, g)
+            value = PlanBase.SKIP
+        else:
+            value = AMLLazyView.view(child, self._root, g, self._cache)
+        self._values[idx] = value
+        return value
+
+    def __getitem__(self, key):
+        idx = self._node.key_index.get(key)
+        if idx is None or self._value(idx) is PlanBase.SKIP:
+            raise KeyError(key)
+        return self._values[idx]
+
+    def __contains__(self, key):
+        idx = self._node.key_index.get(key)
+        return idx is not None and self._value(idx) is not PlanBase.SKIP
+
+    def __iter__(self):
+        for idx, (key, child) in enumerate(self._node.children):
+            if child.kind is PlanBase.KIND_location:
+                continue
+            if self._value(idx) is not PlanBase.SKIP:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class AMLLazyList(AMLLazyView, collections.Sequence):
+    """
+    lazy list result of Plan_List, for_list items is lazy too, length
+    is know when the children before the index is evaluate
+    """
+
+    def __init__(self, node, root, g, cache=None):
+        super(AMLLazyList, self).__init__(node, root, g, cache)
+        # [(start, size, child, g, cur_data)]
+        self._segments = []
+        self._size = 0
+        self._child_idx = 0
+        self._done = False
+
+    def _extend(self):
+        """
+        add segment of next child, False is no more child
+        """
+        children = self._node.children
+        root = self._root
+        while self._child_idx < len(children):
+            child = children[self._child_idx]
+            self._child_idx += 1
+            kind = child.kind
+            g = self._g
+            cur_data = None
+            if kind is PlanBase.KIND_location:
+                self._g = child.locate(root, g)
+                continue
+            elif kind is PlanBase.KIND_multi:
+                cur_data = child.list_data(root, g)
+                size = len(cur_data)
+            elif kind is PlanBase.KIND_stop:
+                child.stop(root, g)
+                continue
+            elif isinstance(child, (Plan_IfKey, Plan_Lookup)):
+                value = AMLLazyView.view(child, root, g, self._cache)
+                if value is PlanBase.SKIP:
+                    continue
+                self._values[self._size] = value
+                size = 1
+            else:
+                size = 1
+            self._segments.append((self._size, size, child, g, cur_data))
+            self._size += size
+            return True
+        self._done = True
+        return False
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0:
+            raise IndexError('list index out of range')
+        if idx in self._values:
+            return self._values[idx]
+        while idx >= self._size:
+            if self._done or not self._extend():
+                raise IndexError('list index out of range')
+
+        segment = self._segment(idx)
+        start, size, child, g, cur_data = segment
+        if cur_data is None:
+            value = AMLLazyView.view(child, self._root, g, self._cache)
+        else:
+            data_item = cur_data[idx - start]
+            value = AMLLazyView.view(child.item, self._root,
+                                     data_item if data_item else g,
+                                     self._cache)
+        self._values[idx] = value
+        return value
+
+    def _segment(self, idx):
+        segments = self._segments
+        lo, hi = 0, len(segments)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if segments[mid][0] <= idx:
+                lo = mid + 1
+            else:
+                hi = mid
+        return segments[lo - 1]
+
+    def __len__(self):
+        while not self._done:
+            self._extend()
+        return self._size
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, collections.Sequence)) or \
+           isinstance(other, basestring):
+            return NotImplemented
+        return len(self) == len(other) and \
+               all(a == b for a, b in itertools.izip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+
+class AMLDependencyIndex(object):
+    """
+    trie of data path -> output path read it
+
+      deep read: read the data and everything under it
+      shallow read: read the data object only (falsy, list length)
+    """
+
+    def __init__(self):
+        # [children, shallow output paths, deep output paths]
+        self._root = [{}, set(), set()]
+
+    def add(self, data_path, out_path, deep):
+        node = self._root
+        for step in data_path:
+            node = node[0].setdefault(step, [{}, set(), set()])
+        node[2 if deep else 1].add(out_path)
+
+    def remove(self, data_path, out_path, deep):
+        node = self._root
+        for step in data_path:
+            node = node[0].get(step)
+            if node is None:
+                return
+        node[2 if deep else 1].discard(out_path)
+
+    def affected(self, data_path):
+        """
+        output paths read the changed data path
+        """
+        result = set()
+        node = self._root
+        for step in data_path:
+            result.update(node[2])
+            node = node[0].get(step)
+            if node is None:
+                return result
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            result.update(node[1])
+            result.update(node[2])
+            stack.extend(node[0].values())
+        return result
+
+
+class AMLOutputRecord(object):
+    """
+    output node of AMLIncremental, data paths it read and the g of it
+    """
+
+    __slots__ = ('node', 'out_path', 'g_path', 'item_path', 'parent',
+                 'children', 'reads')
+
+    def __init__(self, node, out_path, g_path, item_path, parent):
+        self.node = node
+        self.out_path = out_path
+        # g of the node, for_list item g is item_path when the item
+        # data is not falsy else g_path
+        self.g_path = g_path
+        self.item_path = item_path
+        self.parent = parent
+        self.children = []
+        # [(data_path, deep)]
+        self.reads = []
+
+
+class AMLIncremental(object):
+    """
+    run result of compiled template with the dependency index of data
+    path read by every output node (key, index, location,
+    root_location, for_list list, if_key key)
+
+      update(changes) recompute only the output node read the changed
+      data path and patch result in place
+    """
+
+    def __init__(self, template, data):
+        self.template = template
+        self.data = data
+        self._records = {}
+        self._index = AMLDependencyIndex()
+        # {lookup node: data read of template out of the row}
+        self._lookup_reads = {}
+        self.result = None
+        plan = template.plan
+        if plan.kind is PlanBase.KIND_literal:
+            self.result = plan.literal
+        elif plan.kind is PlanBase.KIND_value:
+            result = AMLRunCache().run(self._run_node, plan, data, (), (),
+                                       None)
+            self.result = None if result is PlanBase.SKIP else result
+
+    def update(self, changes, data=None):
+        """
+        changes: data path (AMLPath source) changed in data, a list
+                 change length need the path of the list
+        data: new root data, default is the data changed in place
+        return set of changed output path
+        """
+        return AMLRunCache().run(self._update, changes, data)
+
+    def _update(self, changes, data):
+        if data is not None:
+            self.data = data
+        affected = set()
+        for change in changes:
+            steps = AMLPath(change).steps if change else ()
+            affected.update(self._index.affected(steps))
+
+        # recompute the top affected output node only
+        tops = set()
+        for out_path in sorted(affected, key=len):
+            if not any(out_path[:idx] in tops for idx in xrange(len(out_path))):
+                tops.add(out_path)
+
+        changed = set()
+        for out_path in sorted(tops, key=len):
+            record = self._records.get(out_path)
+            if record is None:
+                continue
+            out_path, old, new = self._rerun(record)
+            if (old is new and isinstance(new, (dict, list))) or old != new:
+                changed.add(str(AMLPath(out_path)))
+        return changed
+
+    @staticmethod
+    def _get(data, path):
+        for step in path:
+            data = data[step]
+        return data
+
+    def _rerun(self, record):
+        try:
+            if record.item_path is not None:
+                g = AMLIncremental._get(self.data, record.item_path)
+                g_path = record.item_path
+                if not g:
+                    g = AMLIncremental._get(self.data, record.g_path)
+                    g_path = record.g_path
+            else:
+                g = AMLIncremental._get(self.data, record.g_path)
+                g_path = record.g_path
+        except (LookupError, TypeError):
+            # the data of g is gone, recompute from parent
+            return self._rerun(record.parent)
+
+        out_path = record.out_path
+        parent = record.parent
+        self._remove(record)
+        fallback_path = None
+        if record.item_path is not None:
+            fallback_path = record.g_path
+        value = self._run_node(record.node, g, g_path, out_path, parent,
+                               fallback_path, record.item_path)
+        if not out_path:
+            old = self.result
+            self.result = None if value is PlanBase.SKIP else value
+            return out_path, old, self.result
+        container = AMLIncremental._get(self.result, out_path[:-1])
+        key = out_path[-1]
+        if isinstance(container, dict):
+            old = container.pop(key, None)
+        else:
+            old = container[key]
+        if value is PlanBase.SKIP:
+            return out_path, old, None
+        container[key] = value
+        return out_path, old, value
+
+    def _remove(self, record):
+        if record.parent is not None:
+            record.parent.children.remove(record)
+        stack = [record]
+        while stack:
+            record = stack.pop()
+            for data_path, deep in record.reads:
+                self._index.remove(data_path, record.out_path, deep)
+            if self._records.get(record.out_path) is record:
+                del self._records[record.out_path]
+            stack.extend(record.children)
+
+    def _read(self, record, data_path, deep):
+        record.reads.append((data_path, deep))
+        self._index.add(data_path, record.out_path, deep)
+
+    def _run_node(self, node, g, g_path, out_path, parent, fallback_path=None,
+                  item_path=None):
+        """
+        record output node and run it
+        """
+        old = self._records.get(out_path)
+        if old is not None:
+            # for_list in dict, the last item win
+            self._remove(old)
+        if item_path is not None:
+            record = AMLOutputRecord(node, out_path, fallback_path,
+                                     item_path, parent)
+            self._read(record, item_path, False)
+        else:
+            record = AMLOutputRecord(node, out_path, g_path, None, parent)
+        self._records[out_path] = record
+        if parent is not None:
+            parent.children.append(record)
+        return self._eval(node, g, g_path, out_path, record)
+
+    @staticmethod
+    def _cur_path(node, g_path):
+        return (() if node._is_root else g_path) + node._locations
+
+    def _eval(self, node, g, g_path, out_path, record):
+        root = self.data
+        if node.kind is PlanBase.KIND_literal:
+            return node.literal
+        if isinstance(node, Plan_Static):
+            return node.value(root, g)
+        if isinstance(node, Plan_Dict):
+            return self._eval_dict(node, g, g_path, out_path, record)
+        if isinstance(node, Plan_List):
+            return self._eval_list(node, g, g_path, out_path, record)
+        if isinstance(node, (Plan_MapKey, Plan_MapIndex)):
+            key = node._key if isinstance(node, Plan_MapKey) else node._index
+            self._read(record, self._cur_path(node, g_path) + (key,), True)
+            return node.value(root, g)
+        if isinstance(node, Plan_IfKey):
+            cur_path = self._cur_path(node, g_path)
+            self._read(record, cur_path + (node._key,), True)
+            self._read(record, cur_path, False)
+            cur_data = node.cur_data(root, g)
+            branch = node.branch(cur_data)
+            if branch is None:
+                return PlanBase.SKIP
+            if cur_data:
+                return self._eval(branch, cur_data, cur_path, out_path, record)
+            return self._eval(branch, g, g_path, out_path, record)
+        if isinstance(node, Plan_Lookup):
+            cur_path = self._cur_path(node, g_path)
+            self._read(record, cur_path + (node._local_key,), True)
+            self._read(record, cur_path, False)
+            # index read every row
+            self._read(record, node._table_steps, True)
+            for data_path, deep in self._lookup_template_reads(node):
+                self._read(record, data_path, deep)
+            return node.value(root, g)
+        # unknow node, read all data
+        self._read(record, (), True)
+        return node.value(root, g)
+
+    def _lookup_template_reads(self, node):
+        """
+        data read of lookup template out of the table, root_location
+        """
+        reads = self._lookup_reads.get(node)
+        if reads is None:
+            reads = []
+            if node._template is not None:
+                read_set = AMLReadSet()
+                rows = node._table_steps + (AMLReadSet.ITEMS,)
+                read_set._analyze(node._template, set([rows]))
+                for data_path, deep in read_set.paths():
+                    if data_path[:len(rows)] == rows:
+                        continue
+                    if AMLReadSet.ITEMS in data_path:
+                        data_path = data_path[:data_path.index(
+                            AMLReadSet.ITEMS)]
+                        deep = True
+                    reads.append((data_path, deep))
+            self._lookup_reads[node] = reads
+        return reads
+
+    def _for_list_data(self, node, g, g_path, record):
+        cur_path = self._cur_path(node, g_path)
+        self._read(record, cur_path, False)
+        cur_data = node.list_data(self.data, g)
+        return cur_path, cur_data
+
+    def _run_item(self, node, data_item, item_path, g, g_path, out_path,
+                  record):
+        item = node.item
+        if item.kind is PlanBase.KIND_literal:
+            return item.literal
+        if data_item:
+            return self._run_node(item, data_item, item_path, out_path, record,
+                                  g_path, item_path)
+        return self._run_node(item, g, g_path, out_path, record, g_path,
+                              item_path)
+
+    def _eval_dict(self, node, g, g_path, out_path, record):
+        root = self.data
+        self._read(record, g_path, False)
+        if not g:
+            g, g_path = root, ()
+        result = {}
+        for key, child in node.children:
+            kind = child.kind
+            if kind is PlanBase.KIND_literal:
+                result[key] = child.literal
+            elif kind is PlanBase.KIND_value:
+                temp = self._run_node(child, g, g_path, out_path + (key,),
+                                      record)
+                if temp is not PlanBase.SKIP:
+                    result[key] = temp
+            elif kind is PlanBase.KIND_location:
+                g_path = (() if child._action_root else g_path) + \
+                         child._action_locations
+                self._read(record, g_path, False)
+                g = child.locate(root, g)
+            elif kind is PlanBase.KIND_multi:
+                cur_path, cur_data = self._for_list_data(child, g, g_path,
+                                                         record)
+                for idx, data_item in enumerate(cur_data):
+                    result[key] = self._run_item(child, data_item,
+                                                 cur_path + (idx,), g, g_path,
+                                                 out_path + (key,), record)
+            else:
+                child.stop(root, g)
+        return result
+
+    def _eval_list(self, node, g, g_path, out_path, record):
+        root = self.data
+        self._read(record, g_path, False)
+        if not g:
+            g, g_path = root, ()
+        result = []
+        for child in node.children:
+            kind = child.kind
+            if kind is PlanBase.KIND_literal:
+                result.append(child.literal)
+            elif kind is PlanBase.KIND_value:
+                if isinstance(child, Plan_IfKey):
+                    # skip branch change the list index
+                    self._read(record, self._cur_path(child, g_path) +
+                               (child._key,), True)
+                elif isinstance(child, Plan_Lookup):
+                    # skip of missing row change the list index
+                    self._read(record, self._cur_path(child, g_path) +
+                               (child._local_key,), True)
+                    self._read(record, child._table_steps, True)
+                temp = self._run_node(child, g, g_path,
+                                      out_path + (len(result),), record)
+                if temp is not PlanBase.SKIP:
+                    result.append(temp)
+            elif kind is PlanBase.KIND_location:
+                g_path = (() if child._action_root else g_path) + \
+                         child._action_locations
+                self._read(record, g_path, False)
+                g = child.locate(root, g)
+            elif kind is PlanBase.KIND_multi:
+                cur_path, cur_data = self._for_list_data(child, g, g_path,
+                                                         record)
+                for idx, data_item in enumerate(cur_data):
+                    result.append(self._run_item(
+                        child, data_item, cur_path + (idx,), g, g_path,
+                        out_path + (len(result),), record))
+            else:
+                child.stop(root, g)
+        return result
+
+
+class AMLRecordError(Exception):
+    """
+    record failure of AML.run_many, in place of the record result
+    """
+
+    def __init__(self, index, error):
+        super(AMLRecordError, self).__init__(index, error)
+        self.index = index
+        self.error = error
+
+    def __str__(self):
+        return 'record %s failed: %s: %s' % (self.index,
+                                              self.error.__class__.__name__,
+                                              self.error)
+
+    __repr__ = __str__
+
+
+class AML(object):
+    """
+    AML instance is reentrant and thread safe, run state is in the
+    AMLStateMachine of the thread, a nested run get a new one
+
+    trace: record state transform of 1 in trace_sample runs in a
+           ring buffer of trace_size events, read by AML.trace()
+    memo_size: opt in memo of sub-template result of a run, key is
+               (sub-template, data it run on), at most memo_size result
+               of a run, the same result object is shared in the run
+               result, 0 is no memo
+    share_static: static sub-template (dict and list without AMLMap)
+                  result is the prebuilt literal shared by every run,
+                  default is a new copy of every run, caller must not
+                  change the shared result
+    """
+
+    def __init__(self, debug=False, level=0, trace=False, trace_size=4096,
+                 trace_sample=1, memo_size=0, share_static=False):
+        self._debug = debug
+        self._level = level
+        self._trace = trace
+        self._trace_size = trace_size
+        self._trace_sample = trace_sample
+        self._memo_size = memo_size
+        self._share_static = share_static
+        self._local = threading.local()
+
+    def compile(self, template, backend=AMLTemplate.BACKEND_plan,
+                profiler=None, code_cache=None):
+        """
+        compile template to AMLTemplate, AMLTemplate.run(data) result
+        is same as AML.run(template, data)
+
+        backend: AMLTemplate.BACKEND_plan or AMLTemplate.BACKEND_codegen
+        profiler: AMLProfiler, profile every node of run
+        code_cache: AMLCodeCache, codegen bytecode on disk
+        """
+        compiler = AMLCompiler(profiler, self._memo_size, self._share_static)
+        plan = compiler.compile(template)
+        return AMLTemplate(template, plan, backend, compiler.run_cache,
+                           self._memo_size, code_cache)
+
+    def run_many(self, template, records, backend=AMLTemplate.BACKEND_plan):
+        """
+        map every data of records, return generator of result
+
+        template compile once (or AMLTemplate), a failed record
+        result is AMLRecordError and the batch go on
+        """
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template, backend)
+        return self._run_many(template.run, records)
+
+    @staticmethod
+    def _run_many(run, records):
+        for index, data in enumerate(records):
+            try:
+                result = run(data)
+            except Exception as e:
+                result = AMLRecordError(index, e)
+            yield result
+
+    def run_parallel(self, template, records, workers=None, chunksize=256,
+                     backend=AMLTemplate.BACKEND_plan):
+        """
+        map records on process pool, return generator of result in
+        records order
+
+        template: template, AMLTemplate or AMLTemplateRef, send to
+                  worker once at pool startup, AMLTemplateRef for
+                  template can not pickle (lambda type ...)
+        workers: process number, default cpu count
+        chunksize: records number of one task
+        a failed record result is AMLRecordError
+        the pool start at first iterate, stop at generator end or close
+        """
+        if isinstance(template, AMLTemplate):
+            backend = template.backend
+            template = template.template
+        workers = workers or multiprocessing.cpu_count()
+        return self._run_parallel(template, backend, records, workers,
+                                  chunksize)
+
+    @staticmethod
+    def _run_parallel(template, backend, records, workers, chunksize):
+        max_pending = workers * 2
+        pending = collections.deque()
+        records = iter(records)
+        start = 0
+        pool = multiprocessing.Pool(workers, _parallel_initialize,
+                                    (template, backend))
+        try:
+            for chunk in iter(lambda: list(itertools.islice(records,
+                                                            chunksize)), []):
+                pending.append(pool.apply_async(_parallel_run_chunk,
+                                                ((start, chunk),)))
+                start += len(chunk)
+                # keep records in memory bounded
+                if len(pending) >= max_pending:
+                    for result in pending.popleft().get():
+                        yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def read_set(self, template):
+        """
+        AMLReadSet, path tree of data read by template
+        """
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template)
+        return template.read_set()
+
+    def load_json(self, template, fp, chunk_size=65536):
+        """
+        decode json of file or byte stream fp, keep only the data read
+        by template (AMLReadSet), AML.run(template, data) of the data
+        is same as the full document
+        """
+        return AMLJSONStream(fp, chunk_size).load(self.read_set(template))
+
+    def run_lazy(self, template, data):
+        """
+        return read only mapping, sequence view of the result, field
+        is evaluate on first access and cached, for_list item is lazy
+
+          template: template or AMLTemplate
+          AMLLazyView.materialize(view) is same as AML.run(template, data)
+        """
+        if isinstance(template, basestring):
+            return template
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template)
+        return template.run_lazy(data)
+
+    def run_incremental(self, template, data):
+        """
+        return AMLIncremental, .result is same as AML.run(template, data),
+        .update(changed data paths) recompute the affected output node
+        and return the changed output paths
+        """
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template)
+        return AMLIncremental(template, data)
+
+    def dump(self, template, data, fp):
+        """
+        write json of run result to writable stream fp as node produced,
+        see AMLJSONWriter
+        """
+        if isinstance(template, basestring):
+            fp.write(json.dumps(template))
+            return
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template)
+        template.dump(data, fp)
+
+    def run_stream(self, template, fp, path=None, chunk_size=65536):
+        """
+        map json document of file or byte stream fp, return generator
+        of item result of the for_list, memory is one item not the
+        document
+
+          only the document before the array of the for_list is load,
+          item is decoded and map one at a time, the data after the
+          array is not read, item template read data out of the array
+          raise AMLTemplateError if the data is not before the array
+          memo of memo_size is of one item, clear at the next item
+        template: template or AMLTemplate, run by plan node
+        path: data path of the array, need by template has more than
+              one for_list
+        """
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template)
+        node, steps, g_steps = template.for_list_target(path)
+        root, array = AMLJSONStream(fp, chunk_size).locate(steps)
+        if array:
+            AMLTemplate.check_stream(node, steps, root)
+        values = node.iter_values(root, AMLTemplate.target_g(root, g_steps))
+        if template.run_cache:
+            return AMLRunCache(template.memo_size).iterate(values,
+                                                           item_memo=True)
+        return values
+
+    def run_columns(self, template, data, path=None, use_numpy=True):
+        """
+        map the for_list of flat item template (literal, map_key,
+        map_index field) field by field, return {key: column}
+
+          column is numpy array when numpy is installed and use_numpy,
+          else array of int, float field or list
+        path: data path of the list, need by template has more than
+              one for_list
+        """
+        if not isinstance(template, AMLTemplate):
+            template = self.compile(template)
+        node, _, g_steps = template.for_list_target(path)
+        if node.fields is None:
+            raise AMLTemplateError("run_columns need for_list item template "
+                                   "of literal, map_key, map_index field: "
+                                   "%s" % node.path)
+        columns = node.columns(data, AMLTemplate.target_g(data, g_steps))
+        types = dict((key, getattr(field, '_type', None))
+                     for key, field in node.fields)
+        return dict((key, AMLTemplate.column_array(column, types[key],
+                                                   use_numpy))
+                    for key, column in columns.items())
+
+    def _new_state_machine(self):
+        trace_buffer = None
+        if self._trace:
+            trace_buffer = AMLTraceBuffer(self._trace_size, self._trace_sample)
+        return AMLStateMachine(self._debug, self._level, trace_buffer,
+                               self._memo_size, self._share_static)
+
+    def _state_machine(self):
+        amlsm = getattr(self._local, 'amlsm', None)
+        if amlsm is None:
+            amlsm = self._local.amlsm = self._new_state_machine()
+        elif amlsm.is_running():
+            # nested run
+            amlsm = self._new_state_machine()
+        return amlsm
+
+    def _assembly_and_map(self, template, data, errors=None):
+        amlsm = self._state_machine()
+        result = amlsm.starting(template, data, errors=errors)
+        if self._debug:
+            # render only when the log emit
+            logging.debug('state transform: %s', amlsm.get_trace())
+        return result
+
+    def trace(self):
+        """
+        AMLTraceBuffer of last sample run of the thread, None is no trace
+        """
+        amlsm = getattr(self._local, 'amlsm', None)
+        return amlsm.get_trace() if amlsm is not None else None
+
+    def run(self, template, data, profiler=None, errors=None):
+        """
+        profiler: AMLProfiler, run on compiled template and profile
+                  every template node
+        errors: AMLErrorCollector, record map_key, map_index miss of the
+                run, AMLErrorCollector(strict=True) raise AMLMapError,
+                default is log of AMLErrorCollector.default
+        """
+        if isinstance(template, basestring):
+            return template
+        if profiler is not None:
+            return self.compile(template, profiler=profiler).run(data, errors)
+        return self._assembly_and_map(template, data, errors)
+
+
+class AMLTemplateRef(object):
+    """
+    template import path 'package.module:NAME', worker process
+    import the template instead of pickle it
+    """
+
+    def __init__(self, path):
+        assert ':' in path, "template path need 'module:name', path:%s" % path
+        self.path = path
+
+    def load(self):
+        module_name, name = self.path.split(':', 1)
+        template = importlib.import_module(module_name)
+        for attr in name.split('.'):
+            template = getattr(template, attr)
+        return template
+
+    def __str__(self):
+        return "<AMLTemplateRef at 0x%x path:%s>" % (id(self), self.path)
+
+    __repr__ = __str__
+
+
+class AMLTemplateRegistry(object):
+    """
+    named and versioned template of a service, compiled once
+
+      register(name, template, version) every template, warm_up()
+      compile all of them at startup, get(name) is the AMLTemplate of
+      the latest version, a template not warm up compile on first get
+      template is template or AMLTemplateRef, load on compile
+      aml: AML of compile, default AML()
+      backend: default backend of register
+      cache_dir: AMLCodeCache directory, codegen bytecode is save there
+                 and a new process load it instead of compile
+                 only bytecode compile is saved, planning and source
+                 generation still run on every compile, and the plan
+                 backend get nothing of the cache, see AMLCodeCache
+    """
+
+    def __init__(self, aml=None, backend=AMLTemplate.BACKEND_plan,
+                 cache_dir=None):
+        self.aml = aml if aml is not None else AML()
+        self.backend = backend
+        self.code_cache = AMLCodeCache(cache_dir) if cache_dir else None
+        # {name: {version: (template, backend)}}
+        self._templates = {}
+        # {(name, version): AMLTemplate}
+        self._compiled = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, template, version=0, backend=None):
+        """
+        raise AMLTemplateError of registered name and version
+        """
+        with self._lock:
+            versions = self._templates.setdefault(name, {})
+            if version in versions:
+                raise AMLTemplateError("template '%s' version %s is "
+                                       "registered" % (name, version))
+            versions[version] = (template, backend or self.backend)
+
+    def names(self):
+        return sorted(self._templates)
+
+    def versions(self, name):
+        return sorted(self._versions(name))
+
+    def _versions(self, name):
+        versions = self._templates.get(name)
+        if not versions:
+            raise AMLTemplateError("template '%s' not registered" % name)
+        return versions
+
+    def get(self, name, version=None):
+        """
+        AMLTemplate of name, latest version of None
+        """
+        versions = self._versions(name)
+        if version is None:
+            version = max(versions)
+        compiled = self._compiled.get((name, version))
+        if compiled is None:
+            compiled = self._compile(name, version)
+        return compiled
+
+    def _compile(self, name, version):
+        with self._lock:
+            compiled = self._compiled.get((name, version))
+            if compiled is not None:
+                return compiled
+            versions = self._versions(name)
+            if version not in versions:
+                raise AMLTemplateError("template '%s' version %s not "
+                                       "registered" % (name, version))
+            template, backend = versions[version]
+            if isinstance(template, AMLTemplateRef):
+                template = template.load()
+            compiled = self.aml.compile(template, backend,
+                                        code_cache=self.code_cache)
+            self._compiled[(name, version)] = compiled
+            return compiled
+
+    def run(self, name, data, version=None, errors=None):
+        return self.get(name, version).run(data, errors)
+
+    def warm_up(self):
+        """
+        compile every registered template, return number of compiled,
+        raise AMLTemplateError of bad template
+        """
+        count = 0
+        for name in self.names():
+            for version in self.versions(name):
+                if (name, version) not in self._compiled:
+                    self._compile(name, version)
+                    count += 1
+        return count
+
+    def __str__(self):
+        return '<AMLTemplateRegistry at 0x%x templates:%s compiled:%s>' % (
+            id(self), sum(len(versions) for versions in
+                          self._templates.itervalues()),
+            len(self._compiled))
+
+    __repr__ = __str__
+
+
+# worker process template of AML.run_parallel
+_parallel_template = None
+
+def _parallel_initialize(template, backend):
+    global _parallel_template
+    if isinstance(template, AMLTemplateRef):
+        template = template.load()
+    _parallel_template = AML().compile(template, backend)
+
+def _parallel_run_chunk(chunk):
+    start, records = chunk
+    run = _parallel_template.run
+    results = []
+    for index, data in enumerate(records, start):
+        try:
+            results.append(run(data))
+        except Exception as e:
+            results.append(AMLRecordError(index, e))
+    return results